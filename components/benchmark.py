@@ -0,0 +1,363 @@
+""" A localhost cluster benchmark for the distributed system. """
+
+import os
+import math
+import time
+import socket
+from queue import Empty
+from multiprocessing import Queue
+
+from components.client import Client
+from components.global_fault_detector import GlobalFaultDetector
+from components.local_fault_detector import LocalFaultDetector
+from components.replication_manager import ReplicationManager
+from components.server import Server
+from components.tracing import TRACE_RATE
+
+PERCENTILES = {'p50': 0.5, 'p99': 0.99, 'p999': 0.999}
+
+FAULTS = ('primary', 'lfd', 'gfd')
+
+# events from whichever component notices a fault first
+DETECTION_EVENTS = ('server_failed', 'primary_lost', 'member_removed',
+                    'gfd_lost')
+
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of sorted values. """
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def cpu_seconds(pid):
+    # user and system time from /proc, None where it is not available
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class Benchmark:
+
+    def __init__(self, num_servers=3, num_clients=1, requests=1000,
+                 active=False, interval=1, window=1, batch=1, keys=0,
+                 partitions=1, port=9000, settle=3, reads=0,
+                 staleness=None, trace_path=None, trace_rate=TRACE_RATE):
+        self._config = {
+            'servers': num_servers, 'clients': num_clients,
+            'requests': requests, 'active': active, 'interval': interval,
+            'window': window, 'batch': batch, 'keys': keys,
+            'partitions': partitions, 'reads': reads, 'staleness': staleness,
+        }
+        self._port = port
+        self._settle = settle
+        # file that servers and clients append sampled spans to, if any
+        self._trace_path = trace_path
+        self._trace_rate = trace_rate
+        self._hostname = socket.gethostname()
+
+        # cluster components by name, in start order
+        self._components = {}
+        self._clients = []
+        self._server_hostports = []
+        self._results = Queue()
+        self._events = None
+
+
+    def _hostport(self, port):
+        return self._hostname + ':' + str(port)
+
+
+    def _start_cluster(self):
+        config = self._config
+        rm = ReplicationManager('RM', self._port, events=self._events,
+                                verbose=False)
+        gfd = GlobalFaultDetector('GFD', self._port + 1,
+                                  self._hostport(self._port),
+                                  events=self._events, verbose=False)
+        self._components['rm'] = rm
+        self._components['gfd'] = gfd
+        rm.start()
+        gfd.start()
+
+        # leave room for each server's partition ports
+        server_ports = [self._port + 10 + i * (config['partitions'] + 1)
+                        for i in range(config['servers'])]
+        self._server_hostports = [self._hostport(port)
+                                  for port in server_ports]
+        for i, port in enumerate(server_ports):
+            peers = [hostport for hostport in self._server_hostports
+                     if hostport != self._server_hostports[i]]
+            server = Server(f'S{i + 1}', port, peers, config['interval'],
+                            config['active'], partitions=config['partitions'],
+                            events=self._events, trace_path=self._trace_path,
+                            verbose=False)
+            self._components[f'server{i + 1}'] = server
+            server.start()
+            # let each server join before the next one elects
+            time.sleep(0.5)
+
+        for i, hostport in enumerate(self._server_hostports):
+            lfd = LocalFaultDetector(f'L{i + 1}', hostport,
+                                     self._hostport(self._port + 1),
+                                     config['interval'], events=self._events,
+                                     verbose=False)
+            self._components[f'lfd{i + 1}'] = lfd
+            lfd.start()
+        time.sleep(self._settle)
+
+
+    def _run_clients(self):
+        config = self._config
+        for i in range(config['clients']):
+            self._clients.append(Client(
+                f'C{i + 1}', self._server_hostports, 0, config['window'],
+                config['batch'], config['keys'], config['reads'],
+                config['staleness'], results=self._results,
+                rm_hostport=self._hostport(self._port),
+                trace_path=self._trace_path, trace_rate=self._trace_rate,
+                verbose=False
+            ))
+
+        start = time.perf_counter()
+        for client in self._clients:
+            client.start(config['requests'])
+        # clients report their own cpu time since they exit when done
+        latencies = []
+        failures = {'timeouts': 0, 'unanswered': 0}
+        cpu = {}
+        connections = {}
+        while len(cpu) < len(self._clients):
+            try:
+                (identifier, client_latencies, timeouts, unanswered, seconds,
+                 health) = self._results.get(timeout=1)
+            except Empty:
+                # a client that exited without reporting
+                if not any(client.is_running() for client in self._clients):
+                    break
+                continue
+            latencies.extend(client_latencies)
+            failures['timeouts'] += timeouts
+            failures['unanswered'] += unanswered
+            cpu['client' + identifier[1:]] = seconds
+            connections['client' + identifier[1:]] = health
+        duration = time.perf_counter() - start
+        return latencies, failures, duration, cpu, connections
+
+
+    def _cpu(self):
+        usage = {}
+        for name, component in self._components.items():
+            seconds = [cpu_seconds(pid) for pid in component.pids()]
+            if None not in seconds:
+                usage[name] = sum(seconds)
+        return usage
+
+
+    def _stop_cluster(self):
+        components = self._clients + list(self._components.values())
+        for component in reversed(components):
+            try:
+                component.stop()
+            except Exception:
+                pass
+
+
+    def run(self):
+        self._start_cluster()
+        try:
+            cpu_before = self._cpu()
+            latencies, failures, duration, client_cpu, connections = \
+                self._run_clients()
+            cpu_after = self._cpu()
+        finally:
+            self._stop_cluster()
+
+        latencies.sort()
+        result = {
+            'config': self._config,
+            'duration': duration,
+            # only requests every group answered count, the rest are failures
+            'requests': len(latencies),
+            'timeouts': failures['timeouts'],
+            'unanswered': failures['unanswered'],
+            'throughput': len(latencies) / duration if duration else None,
+            'latency_ms': {
+                name: (percentile(latencies, fraction) * 1000
+                       if latencies else None)
+                for name, fraction in PERCENTILES.items()
+            },
+            'cpu_seconds': {
+                name: cpu_after[name] - cpu_before.get(name, 0)
+                for name in cpu_after
+            },
+        }
+        result['cpu_seconds'].update(client_cpu)
+        result['connections'] = connections
+        result['latency_ms']['mean'] = (sum(latencies) / len(latencies) * 1000
+                                        if latencies else None)
+        return result
+
+
+def distribution(values):
+    """ Percentiles, mean and max of the observed values. """
+    values = sorted(value for value in values if value is not None)
+    result = {name: percentile(values, fraction)
+              for name, fraction in PERCENTILES.items()}
+    result['mean'] = sum(values) / len(values) if values else None
+    result['max'] = values[-1] if values else None
+    result['count'] = len(values)
+    return result
+
+
+class FailoverBenchmark(Benchmark):
+
+    def __init__(self, fault='primary', runs=10, num_servers=3, active=False,
+                 interval=1, request_interval=0.01, keys=0, partitions=1,
+                 port=9000, settle=3, timeout=20):
+        if fault not in FAULTS:
+            raise ValueError(f'Unknown fault {fault}')
+        super().__init__(num_servers, 1, None, active, interval, keys=keys,
+                         partitions=partitions, port=port, settle=settle)
+        del self._config['requests']
+        self._config.update({'fault': fault, 'runs': runs,
+                             'request_interval': request_interval})
+        self._fault = fault
+        self._runs = runs
+        self._request_interval = request_interval
+        self._timeout = timeout
+
+        # phases timed after the fault, those a failover adds last
+        self._phases = ['detection', 'first_response']
+        if fault == 'primary' and not active:
+            self._phases += ['election', 'backups_ready']
+
+
+    def _collect(self, events, timeout):
+        try:
+            events.append(self._events.get(timeout=timeout))
+            while True:
+                events.append(self._events.get_nowait())
+        except Empty:
+            pass
+
+
+    def _wait_for_client(self, events):
+        # the cluster settles and the client is answered before the fault,
+        # startup events having been queued long before
+        deadline = time.monotonic() + self._settle
+        while time.monotonic() < deadline:
+            self._collect(events, deadline - time.monotonic())
+        deadline = time.monotonic() + self._timeout
+        while not any(name == 'response' for _, _, name, _ in events):
+            if time.monotonic() >= deadline:
+                raise TimeoutError('No response to the client before the '
+                                   'fault')
+            self._collect(events, deadline - time.monotonic())
+
+
+    def _target(self, events):
+        # the server that most recently became primary, or the first one
+        if self._fault == 'gfd':
+            return 'gfd', 'GFD'
+        elected = [identifier for _, identifier, name, _ in events
+                   if name == 'elected']
+        server = elected[-1].split('.')[0] if elected else 'S1'
+        if self._fault == 'primary':
+            return 'server' + server[1:], server
+        return 'lfd' + server[1:], 'L' + server[1:]
+
+
+    def _replicas(self, target):
+        # each surviving partition replica, which is a backup unless elected
+        partitions = self._config['partitions']
+        servers = [f'S{i + 1}' for i in range(self._config['servers'])]
+        if partitions > 1:
+            return {f'{server}.{i}' for server in servers if server != target
+                    for i in range(partitions)}
+        return {server for server in servers if server != target}
+
+
+    def _measure(self, fault_time, target, events):
+        after = [((at - fault_time) * 1000, identifier, name, detail)
+                 for at, identifier, name, detail in events
+                 if at >= fault_time]
+
+        def first(names, exclude=None):
+            return next((ms for ms, identifier, name, detail in after
+                         if name in names and
+                         (detail or identifier).split('.')[0] != exclude),
+                        None)
+
+        phases = {
+            'detection': first(DETECTION_EVENTS),
+            # replies from the stopped server may still be in flight
+            'first_response': first(('response',), exclude=target),
+        }
+        if 'election' in self._phases:
+            phases['election'] = first(('elected',))
+            elected = {identifier for _, identifier, name, _ in after
+                       if name == 'elected'}
+            ready = {}
+            for ms, identifier, name, _ in after:
+                if name == 'ready' and identifier not in elected:
+                    ready.setdefault(identifier, ms)
+            backups = self._replicas(target) - elected
+            phases['backups_ready'] = None
+            if elected and backups <= set(ready):
+                phases['backups_ready'] = max(
+                    [ready[backup] for backup in backups], default=0
+                )
+        return phases
+
+
+    def _run_once(self, port):
+        self._port = port
+        self._components = {}
+        self._clients = []
+        self._events = Queue()
+        events = []
+        self._start_cluster()
+        try:
+            client = Client('C1', self._server_hostports,
+                            self._request_interval, keys=self._config['keys'],
+                            rm_hostport=self._hostport(self._port),
+                            events=self._events, verbose=False)
+            self._clients.append(client)
+            client.start()
+            self._wait_for_client(events)
+
+            name, target = self._target(events)
+            fault_time = time.monotonic()
+            self._components[name].stop()
+
+            deadline = fault_time + self._timeout
+            phases = self._measure(fault_time, target, events)
+            while (None in phases.values() and
+                   time.monotonic() < deadline):
+                self._collect(events, deadline - time.monotonic())
+                phases = self._measure(fault_time, target, events)
+        finally:
+            self._stop_cluster()
+        phases['target'] = target
+        return phases
+
+
+    def run(self):
+        # fresh ports each run, since stopped servers leave sockets behind
+        stride = 10 + self._config['servers'] * (self._config['partitions'] + 1)
+        first_port = self._port
+        runs = []
+        for i in range(self._runs):
+            runs.append(self._run_once(first_port + i * stride))
+        return {
+            'config': self._config,
+            'runs': runs,
+            'failover_ms': {
+                phase: distribution([run[phase] for run in runs])
+                for phase in self._phases
+            },
+        }
@@ -0,0 +1,78 @@
+""" Checkpoint scheduling for the backups of a primary. """
+
+import asyncio
+
+class CheckpointSchedule:
+
+    def __init__(self, interval, max_updates, max_bytes):
+        self._interval = interval
+        self._max_updates = max_updates
+        self._max_bytes = max_bytes
+
+        # totals recorded by the primary
+        self._num_updates = 0
+        self._num_bytes = 0
+
+        # identifier -> [acked updates, bytes when last sent, due event]
+        self._backups = {}
+
+
+    def _is_due(self, backup):
+        acked, sent_bytes, _ = backup
+        if acked is None:
+            return True
+        return (self._num_updates - acked >= self._max_updates or
+                self._num_bytes - sent_bytes >= self._max_bytes)
+
+
+    def add(self, identifier):
+        self._backups[identifier] = [None, self._num_bytes, asyncio.Event()]
+
+
+    def remove(self, identifier):
+        self._backups.pop(identifier, None)
+
+
+    def record(self, num_updates, size):
+        self._num_updates = num_updates
+        self._num_bytes += size
+        for backup in self._backups.values():
+            if not backup[2].is_set() and self._is_due(backup):
+                backup[2].set()
+
+
+    def sent(self, identifier, num_updates):
+        self._num_updates = num_updates
+        self._backups[identifier][1] = self._num_bytes
+
+
+    def unsent_bytes(self, identifier):
+        # recorded since the last checkpoint sent to the backup
+        return self._num_bytes - self._backups[identifier][1]
+
+
+    def acknowledge(self, identifier, num_updates):
+        self._backups[identifier][0] = num_updates
+
+
+    async def wait(self, identifier):
+        # whichever comes first: enough updates, enough bytes or the interval
+        backup = self._backups[identifier]
+        if not self._is_due(backup):
+            try:
+                await asyncio.wait_for(backup[2].wait(), self._interval)
+            except asyncio.TimeoutError:
+                pass
+        backup[2].clear()
+
+
+    def lag(self, identifier):
+        acked = self._backups[identifier][0]
+        if acked is None:
+            return None
+        return self._num_updates - acked
+
+
+    def lags(self):
+        return {identifier: self.lag(identifier)
+                for identifier in self._backups}
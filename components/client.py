@@ -1,135 +1,490 @@
 """ A client in a distributed system. """
 
-import os
-import sys
 import time
 import socket
 import random
+import selectors
+from collections import deque
 from multiprocessing import Process
 
+from components.connection_manager import IO_TIMEOUT, ConnectionManager
+from components.events import Events
+from components.hash_ring import HashRing
+from components.log import Logger, flush_on_terminate
+from components.server_state import (DEFAULT_KEY, READ, is_operation,
+                                     request_key)
+from components.tracing import TRACE_RATE, Tracer
 import components.utils as utils
 
 class Client:
 
-    def __init__(self, identifier, server_hostports, interval, verbose=True):
-        self._stdout = sys.stdout
-        if not verbose:
-            dev_null = open(os.devnull, 'w')
-            self._stdout = dev_null
+    def __init__(self, identifier, server_hostports, interval, window=1,
+                 batch=1, keys=0, reads=0, staleness=None, results=None,
+                 rm_hostport=None, events=None, trace_path=None,
+                 trace_rate=TRACE_RATE, verbose=True):
+        self._logger = Logger(f'Client {identifier}', verbose)
+        # spans of a sample of requests, followed by the servers
+        self._tracer = Tracer(f'Client {identifier}', trace_path, trace_rate)
+        self._traces = {}
+
+        # replica groups, each owning the keys it is given on a hash ring
+        groups = [server_hostports]
+        if server_hostports and isinstance(server_hostports[0], list):
+            groups = server_hostports
+        server_hostports = [hostport for group in groups
+                            for hostport in group]
+        self._group_of = [i for i, group in enumerate(groups)
+                          for hostport in group]
+        self._ring = HashRing({' '.join(sorted(group)): i
+                               for i, group in enumerate(groups)})
 
         # client info
         self._identifier = identifier
         self._server_hostports = server_hostports
         self._interval = interval
-        self._connected = [False for i in range(len(server_hostports))]
+        self._window = max(1, window)
+        self._batch = max(1, batch)
+        self._keys = keys
+
+        # fraction of requests that only read, each answered by one replica
+        # at most staleness updates behind the newest state read from its
+        # group, without a bound if staleness is None
+        self._reads = reads
+        self._staleness = staleness
+        self._versions = {}
+        self._replica_versions = {}
+        self._next_reader = 0
+        self._stale = 0
+
+        # number -> group -> [read, replicas tried] for reads in flight
+        self._queries = {}
+
+        # request numbers awaiting a response from each server
+        self._outstanding = [deque() for i in range(len(server_hostports))]
+
+        # waits on replies from all servers at once
+        self._selector = None
+
+        # live servers by hostport, pushed by the rm, empty to try them all
+        self._rm_hostport = rm_hostport
+        self._rm_sock = None
+        self._live = set()
+        self._epoch = 0
+
+        # latencies of answered requests, and counts of those some group
+        # never answered, reported on the results queue when done
+        self._results = results
+        self._sent = {}
+        self._latencies = []
+        self._timeouts = 0
+        self._unanswered = 0
+
+        self._events = Events(identifier, events)
 
-        # create sockets for each server
-        self._socks = [socket.socket() for i in range(len(server_hostports))]
+        # tells servers apart a retry and a restarted client reusing numbers
+        self._session = random.getrandbits(32)
+
+        # connections to each server, opened as they are needed
+        self._conns = ConnectionManager(identifier, server_hostports,
+                                        self._logger, session=self._session)
 
         # client process
         self._process = None
 
 
-    def _print(self, *args, **kwargs):
-        comb_args = ' '.join(args)
-        print(f'Client {self._identifier}: ' + comb_args, **kwargs,
-              file=self._stdout)
+    def _disconnect(self, index, error):
+        self._conns.fail(index, error)
+        self._outstanding[index].clear()
 
 
     def _close_conns(self):
-        for i in range(len(self._socks)):
-            if self._connected[i]:
-                self._connected[i] = False
-                self._socks[i].close()
-                self._socks[i] = socket.socket()
+        self._conns.close_all()
+        for outstanding in self._outstanding:
+            outstanding.clear()
+        self._unsubscribe()
 
 
-    def _connect(self, index):
+    def _subscribe(self):
+        if self._rm_hostport is None:
+            return
         try:
-            sock = self._socks[index]
-            server_hostport = self._server_hostports[index]
-            self._print(f'Connecting to server at {server_hostport}')
-            sock.connect(utils.address(server_hostport))
-
-            utils.send(sock, self._identifier, 0, 'client')
-            server_identifier, _, _, _ = utils.recv(sock)
-
-            # make sure server is still connected
-            if server_identifier is None:
-                sock.close()
-                self._socks[index] = socket.socket()
-                self._print('Connection closed by server at '
-                            f'{server_hostport}')
-                self._connected[index] = False
+            sock = socket.create_connection(utils.address(self._rm_hostport),
+                                            timeout=IO_TIMEOUT)
+            utils.send(sock, self._identifier, self._epoch, 'subscribe')
+            rm_identifier, _, _, _ = utils.recv(sock)
+        except OSError:
+            self._logger.warning('No RM at {}, trying every server',
+                                 self._rm_hostport)
+            return
+        if rm_identifier is None:
+            sock.close()
+            return
+        self._logger.info('Subscribed to RM {}', rm_identifier)
+        self._rm_sock = sock
+        # the current view comes first
+        self._receive_view()
+        if self._rm_sock is not None and self._selector is not None:
+            self._selector.register(self._rm_sock, selectors.EVENT_READ, None)
+
+
+    def _unsubscribe(self):
+        if self._rm_sock is not None:
+            if self._selector is not None:
+                try:
+                    self._selector.unregister(self._rm_sock)
+                except KeyError:
+                    pass
+            self._rm_sock.close()
+            self._rm_sock = None
+        # without a view every server may be live
+        self._live = set()
+        self._epoch = 0
+
+
+    def _is_live(self, index):
+        return not self._live or self._server_hostports[index] in self._live
+
+
+    def _add_server(self, hostport):
+        # the ring only places new replicas when there is a single group
+        if any(self._group_of):
+            return
+        self._server_hostports.append(hostport)
+        self._group_of.append(0)
+        self._outstanding.append(deque())
+        self._conns.add(hostport)
+
+
+    def _receive_view(self):
+        try:
+            _, _, view, _ = utils.recv(self._rm_sock)
+        except OSError:
+            view = None
+        if view is None:
+            self._logger.info('Connection closed by RM')
+            self._unsubscribe()
+            return
+        epoch, added, removed = view
+        if removed is None:
+            self._live = set(added)
+        elif epoch > self._epoch:
+            self._live = (self._live | set(added)) - set(removed)
+        else:
+            return
+        self._epoch = epoch
+        self._logger.info('Live servers (epoch {}): {}', epoch,
+                          sorted(self._live))
+
+        # connect to new members now rather than after their backoff
+        for hostport in added:
+            if hostport not in self._server_hostports:
+                self._add_server(hostport)
+            if hostport in self._server_hostports:
+                self._conns.connect(self._server_hostports.index(hostport))
+
+
+    def _receive(self, index, responses):
+        server_identifier = self._conns.server_identifier(index)
+        try:
+            _, res_number, res, _ = utils.recv(self._conns.sock(index))
+        except OSError as e:
+            self._disconnect(index, str(e))
+            return
+        if res is None:
+            self._logger.info('Connection closed by Server {}',
+                              server_identifier)
+            self._disconnect(index, 'connection closed')
+            return
+        # one reply per request, retried reads may be queued out of order
+        if res_number in self._outstanding[index]:
+            self._outstanding[index].remove(res_number)
+        if res_number in self._queries:
+            group = self._group_of[index]
+            if res == 'stale':
+                if self._retry(res_number, group):
+                    return
+                self._stale += 1
             else:
-                self._print(f'Connected to Server {server_identifier}')
-                self._connected[index] = True
-            return server_identifier
-        except Exception:
-            self._connected[index] = False
-            return ''
+                self._replica_versions[index] = res[0]
+                self._versions[group] = max(self._versions.get(group, 0),
+                                            res[0])
+        if res != 'ok':
+            if (res_number, self._group_of[index]) not in responses:
+                responses[res_number, self._group_of[index]] = \
+                    time.perf_counter()
+                self._logger.debug('Received (#{}) {} from Server {}',
+                                   res_number, res, server_identifier)
+                self._events.emit('response', server_identifier)
+            else:
+                self._logger.debug('Received (#{}-duplicate) {} from Server '
+                                   '{}', res_number, res, server_identifier)
+
+
+    def _poll(self, timeout, responses):
+        # wake up for connection attempts as well as replies
+        pending = self._conns.timeout()
+        if pending is not None and (timeout is None or pending < timeout):
+            timeout = pending
+        for key, _ in self._selector.select(timeout):
+            index = key.data
+            if index is None:
+                self._receive_view()
+                while (self._rm_sock is not None and
+                       utils.reader(self._rm_sock).has_message()):
+                    self._receive_view()
+                continue
+            if not self._conns.is_connected(index):
+                self._conns.ready(index)
+                continue
+            self._receive(index, responses)
+            # drain replies that arrived in the same read
+            while (self._conns.is_connected(index) and
+                   utils.reader(self._conns.sock(index)).has_message()):
+                self._receive(index, responses)
+        self._conns.expire()
+        # dead replicas are skipped until the rm sees them again
+        self._conns.reconnect(self._is_live)
+
+
+    def _waiting(self, number, group):
+        return [i for i in range(len(self._conns))
+                if self._conns.is_connected(i) and
+                self._group_of[i] == group and number in self._outstanding[i]]
+
+
+    def _incomplete(self, number, groups, responses):
+        return [group for group in groups
+                if (number, group) not in responses and
+                self._waiting(number, group)]
+
+
+    def _complete(self, number, groups, responses):
+        # first reply other than 'ok' from each group wins, the rest are read
+        # as duplicates
+        deadline = self._sent[number] + IO_TIMEOUT
+        incomplete = self._incomplete(number, groups, responses)
+        timed_out = False
+        while incomplete:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                # a server that stopped answering does not hold up the rest
+                for group in incomplete:
+                    for i in self._waiting(number, group):
+                        self._disconnect(i, 'no reply')
+                timed_out = True
+                break
+            self._poll(remaining, responses)
+            incomplete = self._incomplete(number, groups, responses)
+
+        # latency until the last group answered, if every group did
+        received = [responses[number, group] for group in groups
+                    if (number, group) in responses]
+        sent_at = self._sent.pop(number)
+        if timed_out:
+            self._timeouts += 1
+        elif len(received) < len(groups):
+            # sent to no replica of a group, or to none that stayed connected
+            self._unanswered += 1
+        else:
+            self._latencies.append(max(received) - sent_at)
+        span = self._traces.pop(number, None)
+        self._tracer.phase(span, 'wait')
+        self._tracer.finish(span, number=number, groups=len(groups),
+                            read=number in self._queries)
+        self._queries.pop(number, None)
+
+        # forget responses no server can still duplicate
+        pending = [min(self._outstanding[i]) for i in range(len(self._conns))
+                   if self._conns.is_connected(i) and self._outstanding[i]]
+        oldest = min(pending, default=number + 1)
+        for res_number, group in [key for key in responses
+                                  if key[0] < oldest]:
+            del responses[res_number, group]
+
+
+    def _route(self, request):
+        # map each group to the part of the request for keys it owns
+        if isinstance(request, list) and not is_operation(request):
+            parts = {}
+            for item in request:
+                parts.setdefault(self._ring.lookup(request_key(item)),
+                                 []).append(item)
+            return parts
+        return {self._ring.lookup(request_key(request)): request}
+
+
+    def _operation(self):
+        # increment a random key, or the single counter without keys
+        if self._keys > 0:
+            return ['incr', f'key{random.randint(1, self._keys)}',
+                    random.randint(1, 10)]
+        return random.randint(1, 10)
+
+
+    def _query(self):
+        if self._keys > 0:
+            return ['get', f'key{random.randint(1, self._keys)}']
+        return ['get', DEFAULT_KEY]
+
+
+    def _min_version(self, group):
+        if self._staleness is None:
+            return 0
+        return max(0, self._versions.get(group, 0) - self._staleness)
+
+
+    def _reader(self, group):
+        # spread reads over the group's connected replicas
+        replicas = [i for i in range(len(self._conns))
+                    if self._group_of[i] == group and
+                    self._conns.is_connected(i)]
+        if not replicas:
+            return None
+        self._next_reader += 1
+        return replicas[self._next_reader % len(replicas)]
+
+
+    def _retry(self, number, group):
+        """ Sends a read that came back stale to the replica with the newest
+        state read so far, the primary in passive mode. Returns False once
+        every replica has been tried. """
+        read, tried = self._queries[number][group]
+        replicas = [i for i in range(len(self._conns))
+                    if self._group_of[i] == group and
+                    self._conns.is_connected(i) and i not in tried]
+        if not replicas:
+            return False
+        index = max(replicas, key=lambda i: self._replica_versions.get(i, 0))
+        tried.add(index)
+        span = self._traces.get(number)
+        self._send(index, number, read,
+                   None if span is None else span.context())
+        return True
+
+
+    def _send(self, index, number, request, trace=None):
+        self._logger.debug('Sending (#{}) {} to Server {}', number, request,
+                           self._conns.server_identifier(index))
+        try:
+            utils.send(self._conns.sock(index), self._identifier, number,
+                       request, trace=trace)
+        except OSError as e:
+            self._disconnect(index, str(e))
+            return
+        self._outstanding[index].append(number)
+
+
+    def _report(self):
+        health = self._conns.health()
+        for hostport, conn in health.items():
+            self._logger.info('Connection to {}: {}, {} connect(s), {} '
+                              'failure(s)', hostport, conn['state'],
+                              conn['connects'], conn['failures'])
+        if self._results is not None:
+            self._results.put((self._identifier, self._latencies,
+                               self._timeouts, self._unanswered,
+                               time.process_time(), health))
+
+
+    def _connect_all(self):
+        # wait for the first attempts to settle, without blocking on any one
+        self._conns.reconnect(self._is_live)
+        deadline = time.monotonic() + IO_TIMEOUT
+        while (any(self._conns.is_pending(i) for i in range(len(self._conns)))
+               and time.monotonic() < deadline):
+            self._poll(deadline - time.monotonic(), {})
 
 
     def _request(self, limit=None):
-        server_identifiers = ['' for i in range(len(self._socks))]
-        # connect to each server
-        for i in range(len(self._socks)):
-            server_identifiers[i] = self._connect(i)
+        self._selector = selectors.DefaultSelector()
+        self._conns.attach(self._selector)
+        self._subscribe()
+        self._connect_all()
         num_requests = 0
+        in_flight = deque()
+        responses = {}
         while limit is None or num_requests < int(limit):
             num_requests += 1
 
-            if not any(self._connected):
-                self._print(f'Stopping client after {num_requests-1} '
-                            'successful request(s)')
+            if not self._conns.any_usable():
+                self._logger.info('Stopping client after {} successful '
+                                  'request(s)', num_requests - 1)
+                self._report()
                 self._close_conns()
                 return
 
-            # send request to each server
-            request = random.randint(1, 10)
-            response = None
-            for i in range(len(self._socks)):
-                if not self._connected[i]:
-                    self._connect(i)
-                if self._connected[i]:
-                    sock = self._socks[i]
-                    self._print(f'Sending (#{num_requests}) {request} to '
-                                f'Server {server_identifiers[i]}')
-                    utils.send(sock, self._identifier, num_requests, request)
-
-                    _, res_number, res, _ = utils.recv(sock)
-                    if res is None:
-                        self._print('Connection closed by Server '
-                                    f'{server_identifiers[i]}')
-                        sock.close()
-                        self._socks[i] = socket.socket()
-                        self._connected[i] = False
-                    elif res != 'ok':
-                        if response is None:
-                            response = res
-                            self._print(f'Received (#{res_number}) {res} from '
-                                        f'Server {server_identifiers[i]}')
-                        else:
-                            self._print(f'Received (#{res_number}-duplicate) '
-                                        f'{res} from Server '
-                                        f'{server_identifiers[i]}')
+            # send request to each server without waiting for the response
+            read = self._reads > 0 and random.random() < self._reads
+            generate = self._query if read else self._operation
+            if self._batch > 1:
+                request = [generate() for i in range(self._batch)]
+            else:
+                request = generate()
+            parts = self._route(request)
+            self._sent[num_requests] = time.perf_counter()
+            span = trace = None
+            if self._tracer.sample():
+                span = self._traces[num_requests] = self._tracer.start(
+                    'request'
+                )
+                trace = span.context()
+            if read:
+                queries = self._queries[num_requests] = {}
+                for group, part in parts.items():
+                    i = self._reader(group)
+                    if i is not None:
+                        queries[group] = [[READ, self._min_version(group),
+                                           part], {i}]
+                        self._send(i, num_requests, queries[group][0], trace)
+            else:
+                for i in range(len(self._conns)):
+                    # servers still connecting miss this request
+                    if (self._group_of[i] in parts and
+                            self._conns.is_connected(i)):
+                        self._send(i, num_requests,
+                                   parts[self._group_of[i]], trace)
+            self._tracer.phase(span, 'fan_out')
+            in_flight.append((num_requests, list(parts)))
+
+            # read duplicates that have already arrived
+            self._poll(0, responses)
+
+            # wait for the oldest request once the window is full
+            if len(in_flight) >= self._window:
+                self._complete(*in_flight.popleft(), responses)
 
             time.sleep(self._interval)
 
-        self._print(f'Completed {num_requests} request(s)')
+        while in_flight:
+            self._complete(*in_flight.popleft(), responses)
+
+        self._logger.info('Completed {} request(s)', num_requests)
+        if self._timeouts or self._unanswered:
+            self._logger.warning('{} request(s) timed out, {} unanswered',
+                                 self._timeouts, self._unanswered)
+        if self._stale:
+            self._logger.warning('{} read(s) too stale to answer', self._stale)
+        self._report()
         self._close_conns()
-        for i, identifier in enumerate(server_identifiers):
-            if self._connected[i]:
-                self._print(f'Connection to Server {identifier} closed')
+
+
+    def _run(self, limit):
+        flush_on_terminate(self._tracer.flush)
+        try:
+            self._request(limit)
+        finally:
+            # the process exits without running atexit handlers
+            self._logger.flush()
+            self._tracer.flush()
 
 
     def start(self, limit=None):
-        self._process = Process(target=self._request, args=[limit])
+        self._process = Process(target=self._run, args=[limit])
         self._process.start()
 
 
     def stop(self):
-        self._print('Stopping client')
+        self._logger.info('Stopping client')
         if self._process is not None:
             self._process.terminate()
             self._close_conns()
@@ -137,3 +492,7 @@ class Client:
 
     def is_running(self):
         return self._process.is_alive()
+
+
+    def pids(self):
+        return [self._process.pid]
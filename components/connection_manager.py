@@ -0,0 +1,242 @@
+""" Client connections to servers, opened without blocking. """
+
+import time
+import errno
+import socket
+import selectors
+
+from components.log import Logger
+import components.utils as utils
+
+# seconds to connect and hear back from the server
+CONNECT_TIMEOUT = 1.0
+
+# seconds a blocked send or an unanswered request may take before the
+# connection is dropped
+IO_TIMEOUT = 5.0
+
+# seconds to wait before reconnecting, doubled after each failure
+BACKOFF_MIN = 0.05
+BACKOFF_MAX = 5.0
+
+DISCONNECTED = 'disconnected'
+CONNECTING = 'connecting'
+HANDSHAKE = 'handshake'
+CONNECTED = 'connected'
+
+
+def _configure(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # notice a silent peer within seconds where the platform allows it
+    for option, value in (('TCP_KEEPIDLE', 5), ('TCP_KEEPINTVL', 1),
+                          ('TCP_KEEPCNT', 3)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option),
+                            value)
+
+
+class Connection:
+
+    def __init__(self, hostport):
+        self.hostport = hostport
+        self.sock = None
+        self.state = DISCONNECTED
+        self.server_identifier = ''
+
+        # when the current attempt gives up, and when to make the next one
+        self.deadline = None
+        self.retry_at = 0.0
+        self.backoff = BACKOFF_MIN
+
+        # health
+        self.connects = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_error = None
+
+
+class ConnectionManager:
+
+    def __init__(self, identifier, hostports, logger=None,
+                 connect_timeout=CONNECT_TIMEOUT, session=0):
+        self._identifier = identifier
+        # sent with each handshake
+        self._session = session
+        self._conns = [Connection(hostport) for hostport in hostports]
+        self._logger = logger
+        if logger is None:
+            self._logger = Logger(f'Client {identifier}')
+        self._connect_timeout = connect_timeout
+        self._selector = None
+
+
+    def __len__(self):
+        return len(self._conns)
+
+
+    def attach(self, selector):
+        # sockets register under their index once the selector exists
+        self._selector = selector
+
+
+    def add(self, hostport):
+        self._conns.append(Connection(hostport))
+        return len(self._conns) - 1
+
+
+    def sock(self, index):
+        return self._conns[index].sock
+
+
+    def server_identifier(self, index):
+        return self._conns[index].server_identifier
+
+
+    def is_connected(self, index):
+        return self._conns[index].state == CONNECTED
+
+
+    def is_pending(self, index):
+        return self._conns[index].state in (CONNECTING, HANDSHAKE)
+
+
+    def any_usable(self):
+        return any(conn.state != DISCONNECTED for conn in self._conns)
+
+
+    def _close(self, conn):
+        if conn.sock is not None:
+            if self._selector is not None:
+                try:
+                    self._selector.unregister(conn.sock)
+                except (KeyError, ValueError):
+                    pass
+            conn.sock.close()
+            conn.sock = None
+        conn.state = DISCONNECTED
+        conn.deadline = None
+
+
+    def connect(self, index, now=None):
+        """ Starts connecting to a server unless already connected or
+        connecting. Returns without waiting for the server. """
+        conn = self._conns[index]
+        if conn.state != DISCONNECTED:
+            return
+        now = time.monotonic() if now is None else now
+        self._logger.info('Connecting to server at {}', conn.hostport)
+        try:
+            conn.sock = socket.socket()
+            conn.sock.setblocking(False)
+            _configure(conn.sock)
+            error = conn.sock.connect_ex(utils.address(conn.hostport))
+        except OSError as e:
+            self.fail(index, str(e), now)
+            return
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.fail(index, errno.errorcode.get(error, str(error)), now)
+            return
+        conn.state = CONNECTING
+        conn.deadline = now + self._connect_timeout
+        self._selector.register(conn.sock, selectors.EVENT_WRITE, index)
+
+
+    def reconnect(self, live, now=None):
+        """ Starts connecting to each live server whose backoff has passed. """
+        now = time.monotonic() if now is None else now
+        for index, conn in enumerate(self._conns):
+            if (conn.state == DISCONNECTED and conn.retry_at <= now and
+                    live(index)):
+                self.connect(index, now)
+
+
+    def ready(self, index):
+        """ Advances a pending connection whose socket is ready. Returns
+        whether it is now connected. """
+        conn = self._conns[index]
+        try:
+            if conn.state == CONNECTING:
+                error = conn.sock.getsockopt(socket.SOL_SOCKET,
+                                             socket.SO_ERROR)
+                if error:
+                    self.fail(index, errno.errorcode.get(error, str(error)))
+                    return False
+                # sends and reads block, but not for longer than this
+                conn.sock.settimeout(IO_TIMEOUT)
+                utils.send(conn.sock, self._identifier, self._session,
+                           'client')
+                conn.state = HANDSHAKE
+                self._selector.modify(conn.sock, selectors.EVENT_READ, index)
+                return False
+
+            server_identifier, _, _, _ = utils.recv(conn.sock)
+        except OSError as e:
+            self.fail(index, str(e))
+            return False
+        # make sure server is still connected
+        if server_identifier is None:
+            self.fail(index, 'connection closed')
+            return False
+        conn.state = CONNECTED
+        conn.server_identifier = server_identifier
+        conn.deadline = None
+        conn.backoff = BACKOFF_MIN
+        conn.connects += 1
+        conn.consecutive_failures = 0
+        self._logger.info('Connected to Server {}', server_identifier)
+        return True
+
+
+    def fail(self, index, error, now=None):
+        """ Drops a connection and schedules the next attempt. """
+        conn = self._conns[index]
+        now = time.monotonic() if now is None else now
+        self._close(conn)
+        conn.failures += 1
+        conn.consecutive_failures += 1
+        conn.last_error = error
+        conn.retry_at = now + conn.backoff
+        self._logger.warning('Connection to server at {} failed ({}), '
+                             'retrying in {:.2f}s', conn.hostport, error,
+                             conn.backoff)
+        conn.backoff = min(conn.backoff * 2, BACKOFF_MAX)
+
+
+    def expire(self, now=None):
+        # attempts that took too long
+        now = time.monotonic() if now is None else now
+        for index, conn in enumerate(self._conns):
+            if conn.deadline is not None and conn.deadline <= now:
+                self.fail(index, 'timed out', now)
+
+
+    def timeout(self, now=None):
+        """ Seconds until the next attempt gives up or may start, or None. """
+        now = time.monotonic() if now is None else now
+        times = [conn.deadline for conn in self._conns
+                 if conn.deadline is not None]
+        times += [conn.retry_at for conn in self._conns
+                  if conn.state == DISCONNECTED and conn.retry_at > now]
+        if not times:
+            return None
+        return max(0.0, min(times) - now)
+
+
+    def close_all(self):
+        for conn in self._conns:
+            self._close(conn)
+
+
+    def health(self):
+        return {
+            conn.hostport: {
+                'state': conn.state,
+                'server': conn.server_identifier,
+                'connects': conn.connects,
+                'failures': conn.failures,
+                'consecutive_failures': conn.consecutive_failures,
+                'last_error': conn.last_error,
+            }
+            for conn in self._conns
+        }
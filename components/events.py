@@ -0,0 +1,16 @@
+""" Timestamped events that fault-injection benchmarks time failover with. """
+
+import time
+
+class Events:
+
+    def __init__(self, identifier, queue=None):
+        self._identifier = identifier
+        # queue of (time, identifier, event, detail), if anyone listens
+        self._queue = queue
+
+
+    def emit(self, name, detail=None):
+        if self._queue is not None:
+            self._queue.put((time.monotonic(), self._identifier, name,
+                             detail))
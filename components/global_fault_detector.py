@@ -1,20 +1,22 @@
 """ A global fault detector in a distributed system. """
 
-import os
-import sys
+import json
+import time
 import socket
 from multiprocessing import Process
-from threading import Thread
+from threading import Lock, Thread
 
+from components.events import Events
+from components.log import Logger, flush_on_terminate
+from components.membership import MembershipView
+from components.metrics import Metrics
 import components.utils as utils
 
 class GlobalFaultDetector:
 
-    def __init__(self, identifier, port, rm_hostport, verbose=True):
-        self._stdout = sys.stdout
-        if not verbose:
-            dev_null = open(os.devnull, 'w')
-            self._stdout = dev_null
+    def __init__(self, identifier, port, rm_hostport, events=None,
+                 verbose=True):
+        self._logger = Logger(f'GFD {identifier}', verbose)
 
         # gfd info
         self._identifier = identifier
@@ -27,22 +29,30 @@ class GlobalFaultDetector:
         self._rm_sock = socket.socket()
         self._rm_connected = False
 
-        # membership
-        self._members = []
+        # membership, and members an lfd suspects of failing
+        self._view = MembershipView()
+        self._suspects = set()
+        # orders updates from lfd threads and their deltas to the rm
+        self._lock = Lock()
 
-        # gfd process
-        self._process = None
+        self._events = Events(identifier, events)
 
+        # counters and latencies, answered to stats connections with the
+        # latest stats each lfd sent
+        self._metrics = Metrics('gfd', identifier)
+        self._metrics.gauge('epoch', self._view.epoch)
+        self._metrics.gauge('members', lambda: len(self._view))
+        self._metrics.gauge('suspects', lambda: len(self._suspects))
+        self._metrics.gauge('rm_connected', lambda: self._rm_connected)
+        self._lfd_stats = {}
 
-    def _print(self, *args, **kwargs):
-        comb_args = ' '.join(args)
-        print(f'GFD {self._identifier}: ' + comb_args, **kwargs,
-              file=self._stdout)
+        # gfd process
+        self._process = None
 
 
     def _connect(self):
         try:
-            self._print(f'Connecting to RM at {self._rm_hostport}')
+            self._logger.info('Connecting to RM at {}', self._rm_hostport)
             self._rm_sock.connect(utils.address(self._rm_hostport))
 
             utils.send(self._rm_sock, self._identifier, 0, 'gfd')
@@ -51,45 +61,111 @@ class GlobalFaultDetector:
             if rm_identifier is None:
                 self._rm_sock.close()
                 self._rm_sock = socket.socket()
-                self._print('Connection closed by RM at '
-                            f'{self._rm_hostport}')
+                self._logger.info('Connection closed by RM at {}',
+                                  self._rm_hostport)
                 self._rm_connected = False
-            self._print(f'Connected to RM {rm_identifier}')
+                return
+            self._logger.info('Connected to RM {}', rm_identifier)
+            # only deltas follow the full view
+            utils.send(self._rm_sock, self._identifier, 0, self._view.full())
             self._rm_connected = True
         except Exception:
             self._rm_connected = False
 
 
     def _handle_lfd(self, conn, lfd_identifier):
-        self._print(f'Connection from LFD {lfd_identifier}')
+        self._logger.info('Connection from LFD {}', lfd_identifier)
 
+        # servers this lfd has registered
+        monitored = set()
         _, _, message, _ = utils.recv(conn)
         while message is not None:
-            if not self._rm_connected:
-                self._connect()
-            if message == 'add':
-                self._members.append(lfd_identifier)
-                self._print(f'Added member {lfd_identifier}')
-                self._print(f'Current members: {self._members}')
-                if self._rm_connected:
-                    utils.send(self._rm_sock, lfd_identifier, 0, 'add')
-            elif message == 'remove':
-                self._members.remove(lfd_identifier)
-                self._print(f'Removed member {lfd_identifier}')
-                self._print(f'Current members: {self._members}')
-                if self._rm_connected:
-                    utils.send(self._rm_sock, lfd_identifier, 0, 'remove')
+            if isinstance(message, str):
+                # the lfd's stats, decoded only when asked for
+                self._lfd_stats[lfd_identifier] = message
+                _, _, message, _ = utils.recv(conn)
+                continue
+            added, removed, _, _ = message
+            monitored.update(added)
+            monitored.difference_update(removed)
+            started_at = time.perf_counter()
+            self._update(lfd_identifier, message)
+            self._metrics.incr('deltas')
+            self._metrics.time('update_us', time.perf_counter() - started_at)
             _, _, message, _ = utils.recv(conn)
 
-        self._print(f'Connection closed by LFD {lfd_identifier}')
-        if lfd_identifier in self._members:
-            self._members.remove(lfd_identifier)
-            self._print(f'Removed member {lfd_identifier}')
-            self._print(f'Current members: {self._members}')
+        self._logger.info('Connection closed by LFD {}', lfd_identifier)
+        self._lfd_stats.pop(lfd_identifier, None)
+        if monitored:
+            self._update(lfd_identifier, [[], list(monitored), [], []])
+
+
+    def _update(self, lfd_identifier, delta):
+        added, removed, suspected, trusted = delta
+        with self._lock:
+            for member in suspected:
+                self._suspects.add(member)
+                self._logger.info('Suspecting member {}', member)
+            for member in trusted:
+                self._suspects.discard(member)
+                self._logger.info('Trusting member {}', member)
+            self._suspects.difference_update(removed)
+            self._metrics.incr('suspicions', len(suspected))
+            self._metrics.incr('trusts', len(trusted))
+
+            change = self._view.apply(added, removed)
+            if change is None:
+                return
+            epoch, added, removed = change
+            self._metrics.incr('members_added', len(added))
+            self._metrics.incr('members_removed', len(removed))
+            for member in added:
+                self._logger.info('Added member {}', member)
+            for member in removed:
+                self._logger.info('Removed member {}', member)
+                self._events.emit('member_removed', member)
+            self._logger.info('Current members (epoch {}): {}', epoch,
+                              self._view.members())
+
+            # pass on only what changed, a new connection sends the full view
+            if not self._rm_connected:
+                self._connect()
+            else:
+                try:
+                    utils.send(self._rm_sock, lfd_identifier, 0, change)
+                except OSError:
+                    self._rm_sock.close()
+                    self._rm_sock = socket.socket()
+                    self._rm_connected = False
+
+
+    def _handle_view(self, conn, identifier):
+        self._logger.debug('Membership queries from {}', identifier)
+
+        # each query asks for the changes since the epoch in its number
+        _, epoch, query, _ = utils.recv(conn)
+        while query is not None:
+            utils.send(conn, self._identifier, epoch,
+                       self._view.changes_since(epoch))
+            _, epoch, query, _ = utils.recv(conn)
+
+
+    def _handle_stats(self, conn):
+        # each message asks for a fresh snapshot
+        _, number, data, _ = utils.recv(conn)
+        while data is not None:
+            stats = self._metrics.snapshot()
+            stats['lfds'] = {identifier: json.loads(lfd_stats)
+                             for identifier, lfd_stats
+                             in list(self._lfd_stats.items())}
+            utils.send(conn, self._identifier, number,
+                       json.dumps(stats, separators=(',', ':')))
+            _, number, data, _ = utils.recv(conn)
 
 
     def _listen(self):
-        self._print(f'Starting at hostport {self._hostport}')
+        flush_on_terminate()
+        self._logger.info('Starting at hostport {}', self._hostport)
         self._sock.listen()
 
         # connect to rm
@@ -102,6 +178,11 @@ class GlobalFaultDetector:
             # check for lfd
             if data == 'lfd':
                 Thread(target=self._handle_lfd, args=[conn, identifier]).start()
+            elif data == 'view':
+                Thread(target=self._handle_view,
+                       args=[conn, identifier]).start()
+            elif data == 'stats':
+                Thread(target=self._handle_stats, args=[conn]).start()
 
 
     def start(self):
@@ -110,15 +191,24 @@ class GlobalFaultDetector:
 
 
     def stop(self):
-        self._print('Stopping GFD')
+        self._logger.info('Stopping GFD')
         if self._process is not None:
             self._process.terminate()
             self._sock.shutdown(socket.SHUT_RDWR)
+            # let the rm see the connection close
+            try:
+                self._rm_sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
 
     def is_running(self):
         return self._process.is_alive()
 
 
+    def pids(self):
+        return [self._process.pid]
+
+
     def hostport(self):
         return self._hostport
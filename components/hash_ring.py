@@ -0,0 +1,44 @@
+""" Consistent hashing of keys onto replica groups. """
+
+import hashlib
+from bisect import bisect, insort
+
+# points on the ring for each group, to even out the share of keys
+VIRTUAL_NODES = 64
+
+
+def _hash(key):
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+class HashRing:
+
+    def __init__(self, groups=None):
+        self._points = []
+        self._owners = {}
+        for label, group in (groups or {}).items():
+            self.add(label, group)
+
+
+    def add(self, label, group):
+        # points depend only on the label, so other groups keep their keys
+        for i in range(VIRTUAL_NODES):
+            point = _hash(f'{label}#{i}')
+            if point not in self._owners:
+                insort(self._points, point)
+            self._owners[point] = group
+
+
+    def remove(self, label):
+        for i in range(VIRTUAL_NODES):
+            point = _hash(f'{label}#{i}')
+            if self._owners.pop(point, None) is not None:
+                self._points.remove(point)
+
+
+    def lookup(self, key):
+        if not self._points:
+            return None
+        index = bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[self._points[index]]
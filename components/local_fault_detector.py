@@ -1,129 +1,279 @@
 """ A local fault detector in a distributed system. """
 
-import os
-import sys
 import time
-import socket
+import asyncio
 from multiprocessing import Process
 
+from components.events import Events
+from components.log import Logger, flush_on_terminate
+from components.metrics import Metrics
+from components.phi_accrual import PhiAccrualDetector
 import components.utils as utils
 
+# suspicion levels at which a silent server is reported to the gfd
+SUSPECT_PHI = 3
+REMOVE_PHI = 8
+
 class LocalFaultDetector:
 
-    def __init__(self, identifier, server_hostport, gfd_hostport, interval,
-                 verbose=True):
-        self._stdout = sys.stdout
-        if not verbose:
-            dev_null = open(os.devnull, 'w')
-            self._stdout = dev_null
+    def __init__(self, identifier, server_hostports, gfd_hostport, interval,
+                 suspect_threshold=SUSPECT_PHI, remove_threshold=REMOVE_PHI,
+                 events=None, verbose=True):
+        self._logger = Logger(f'LFD {identifier}', verbose)
+
+        # a single server or every server on the host
+        if isinstance(server_hostports, str):
+            server_hostports = [server_hostports]
 
         # lfd info
         self._identifier = identifier
-        self._server_hostport = server_hostport
+        self._server_hostports = server_hostports
         self._gfd_hostport = gfd_hostport
         self._interval = interval
+        self._suspect_threshold = suspect_threshold
+        self._remove_threshold = remove_threshold
+
+        # connections to each server, opened in the lfd process
+        self._server_conns = [None for hostport in server_hostports]
+        self._server_identifiers = [None for hostport in server_hostports]
+
+        # heartbeat replies from each connection, read as they arrive
+        self._receivers = [None for hostport in server_hostports]
+        self._replied = [None for hostport in server_hostports]
+        self._detectors = [None for hostport in server_hostports]
+        # (number, time) of the last heartbeat sent to each server
+        self._sent = [None for hostport in server_hostports]
 
-        # create sockets
-        self._server_sock = socket.socket()
-        self._gfd_sock = socket.socket()
+        # servers registered with the gfd, and those suspected of failing
+        self._members = set()
+        self._suspects = set()
+
+        self._events = Events(identifier, events)
+
+        # counters and latencies, sent to the gfd with each round since the
+        # lfd has no listening socket
+        self._metrics = Metrics('lfd', identifier)
+        self._metrics.gauge('members', lambda: len(self._members))
+        self._metrics.gauge('suspects', lambda: len(self._suspects))
+        self._metrics.gauge('phi', self._phis)
 
         # lfd process
         self._process = None
 
 
-    def _print(self, *args, **kwargs):
-        comb_args = ' '.join(args)
-        print(f'LFD {self._identifier}: ' + comb_args, **kwargs,
-              file=self._stdout)
+    def _phis(self):
+        now = time.monotonic()
+        return {hostport: (round(detector.phi(now), 2)
+                           if detector is not None else None)
+                for hostport, detector in zip(self._server_hostports,
+                                              self._detectors)}
+
 
+    def _disconnect(self, index):
+        if self._receivers[index] is not None:
+            self._receivers[index].cancel()
+            self._receivers[index] = None
+        if self._server_conns[index] is not None:
+            _, writer = self._server_conns[index]
+            writer.close()
+            self._server_conns[index] = None
 
-    def _connect(self):
+
+    async def _handshake(self, index):
+        reader, writer = await asyncio.open_connection(
+            *utils.address(self._server_hostports[index])
+        )
+        self._server_conns[index] = (reader, writer)
+        await utils.send_async(writer, self._identifier, 0, 'lfd')
+        server_identifier, _, _, _ = await utils.recv_async(reader)
+        return server_identifier
+
+
+    async def _connect(self, index):
+        server_hostport = self._server_hostports[index]
+        self._logger.info('Connecting to server at {}', server_hostport)
         try:
-            self._print(f'Connecting to server at {self._server_hostport}')
-            self._server_sock.connect(utils.address(self._server_hostport))
-
-            utils.send(self._server_sock, self._identifier, 0, 'lfd')
-            server_identifier, _, _, _ = utils.recv(self._server_sock)
-            # make sure server is still connected
-            if server_identifier is None:
-                self._server_sock.close()
-                self._server_sock = socket.socket()
-                self._print('Connection closed by server at '
-                            f'{self._server_hostport}')
-                return False, server_identifier
-            self._print(f'Connected to Server {server_identifier}')
-            return True, server_identifier
+            # a hung server may accept connections without answering
+            server_identifier = await asyncio.wait_for(
+                self._handshake(index), self._interval
+            )
         except Exception:
-            return False, None
+            server_identifier = None
+        # make sure server is still connected
+        if server_identifier is None:
+            self._disconnect(index)
+            self._logger.warning('No connection to server at {}',
+                                 server_hostport)
+            return
+        self._logger.info('Connected to Server {}', server_identifier)
+        self._metrics.incr('connects')
+        self._server_identifiers[index] = server_identifier
 
+        reader, _ = self._server_conns[index]
+        self._detectors[index] = PhiAccrualDetector(self._interval)
+        self._detectors[index].heartbeat(time.monotonic())
+        self._replied[index] = asyncio.Event()
+        self._receivers[index] = asyncio.create_task(
+            self._receive(index, reader)
+        )
+
+
+    async def _receive(self, index, reader):
+        # replies that miss their deadline still count when they arrive
+        server_identifier = self._server_identifiers[index]
+        while True:
+            _, res_number, response, _ = await utils.recv_async(reader)
+            if response is None:
+                self._replied[index].set()
+                return
+            now = time.monotonic()
+            self._detectors[index].heartbeat(now)
+            number, sent_at = self._sent[index]
+            if res_number == number:
+                self._metrics.time('heartbeat_rtt_us', now - sent_at)
+            self._logger.debug('Heartbeat response #{} from Server {}',
+                               res_number, server_identifier)
+            self._replied[index].set()
 
-    def _heartbeat(self):
-        # connect to server
-        connected, server_identifier = self._connect()
 
+    async def _beat(self, index, number):
+        """ Returns whether the server is 'alive', 'suspect' or 'failed'
+        after heartbeat number. """
+        if self._server_conns[index] is None:
+            await self._connect(index)
+        if self._server_conns[index] is None:
+            return 'failed'
+
+        _, writer = self._server_conns[index]
+        server_identifier = self._server_identifiers[index]
+        self._logger.debug('Sending heartbeat #{} to Server {}', number,
+                           server_identifier)
+        replied = self._replied[index]
+        replied.clear()
+        self._sent[index] = (number, time.monotonic())
+        self._metrics.incr('heartbeats')
+        try:
+            await asyncio.wait_for(
+                utils.send_async(writer, self._identifier, number,
+                                 'heartbeat'),
+                self._interval
+            )
+            await asyncio.wait_for(replied.wait(), self._interval)
+        except (asyncio.TimeoutError, OSError):
+            self._metrics.incr('missed_heartbeats')
+
+        if self._receivers[index].done():
+            self._logger.warning('No response from Server {}',
+                                 server_identifier)
+            self._events.emit('server_failed', server_identifier)
+            self._metrics.incr('failures')
+            self._disconnect(index)
+            return 'failed'
+        phi = self._detectors[index].phi(time.monotonic())
+        if phi >= self._remove_threshold:
+            self._logger.warning('Server {} unresponsive (phi {:.1f})',
+                                 server_identifier, phi)
+            self._events.emit('server_failed', server_identifier)
+            self._metrics.incr('failures')
+            self._disconnect(index)
+            return 'failed'
+        if phi >= self._suspect_threshold:
+            self._logger.warning('Server {} suspected (phi {:.1f})',
+                                 server_identifier, phi)
+            self._metrics.incr('suspicions')
+            return 'suspect'
+        return 'alive'
+
+
+    async def _heartbeat(self):
         # connect to gfd
-        self._print(f'Connecting to GFD at {self._gfd_hostport}')
-        self._gfd_sock.connect(utils.address(self._gfd_hostport))
+        self._logger.info('Connecting to GFD at {}', self._gfd_hostport)
+        gfd_reader, gfd_writer = await asyncio.open_connection(
+            *utils.address(self._gfd_hostport)
+        )
 
-        utils.send(self._gfd_sock, self._identifier, 0, 'lfd')
-        gfd_identifier, _, _, _ = utils.recv(self._gfd_sock)
+        await utils.send_async(gfd_writer, self._identifier, 0, 'lfd')
+        gfd_identifier, _, _, _ = await utils.recv_async(gfd_reader)
         # make sure gfd is still connected
         if gfd_identifier is None:
-            self._gfd_sock.close()
-            self._gfd_sock = socket.socket()
-            self._print('Connection closed by GFD at '
-                        f'{self._gfd_hostport}')
+            gfd_writer.close()
+            self._logger.info('Connection closed by GFD at {}',
+                              self._gfd_hostport)
             return
-        self._print(f'Connected to GFD {gfd_identifier}')
-        member = False
+        self._logger.info('Connected to GFD {}', gfd_identifier)
 
         number = 1
         while True:
-            if not connected:
-                connected, server_identifier = self._connect()
-            if connected:
-                self._print(f'Sending heartbeat #{number} to Server '
-                            f'{server_identifier}')
-                utils.send(self._server_sock, self._identifier, number,
-                           'heartbeat')
-
-                _, res_number, response, _ = utils.recv(self._server_sock)
-                if response is None:
-                    self._print(f'No response from Server {server_identifier}')
-                    self._server_sock.close()
-                    self._server_sock = socket.socket()
-                    connected = False
-                    if member:
-                        self._print(f'Alerting GFD')
-                        utils.send(self._gfd_sock, self._identifier, 0,
-                                   'remove')
-                        member = False
-                else:
-                    self._print(f'Heartbeat response #{res_number} from Server '
-                                f'{server_identifier}')
-                    if not member:
-                        self._print(f'Registering membership with GFD')
-                        utils.send(self._gfd_sock, self._identifier, 0, 'add')
-                        member = True
-
-                number += 1
-            time.sleep(self._interval)
+            start = time.monotonic()
+            # heartbeat every server at once
+            statuses = await asyncio.gather(*[
+                self._beat(i, number)
+                for i in range(len(self._server_hostports))
+            ])
+
+            delta = self._delta(statuses)
+            # one membership delta per round
+            if any(delta):
+                added, removed, suspected, trusted = delta
+                self._logger.info('Updating GFD membership: added {}, '
+                                  'removed {}, suspected {}, trusted {}',
+                                  added, removed, suspected, trusted)
+                await utils.send_async(gfd_writer, self._identifier, number,
+                                       delta)
+            await utils.send_async(gfd_writer, self._identifier, number,
+                                   self._metrics.encode())
+
+            number += 1
+            await asyncio.sleep(max(0, start + self._interval -
+                                    time.monotonic()))
+
+
+    def _delta(self, statuses):
+        added = []
+        removed = []
+        suspected = []
+        trusted = []
+        for i, status in enumerate(statuses):
+            # members are named by the hostport clients reach them at
+            member = self._server_hostports[i]
+            if status == 'failed':
+                self._suspects.discard(i)
+                if i in self._members:
+                    self._members.remove(i)
+                    removed.append(member)
+                continue
+            if i not in self._members:
+                self._members.add(i)
+                added.append(member)
+            if status == 'suspect' and i not in self._suspects:
+                self._suspects.add(i)
+                suspected.append(member)
+            elif status == 'alive' and i in self._suspects:
+                self._suspects.remove(i)
+                trusted.append(member)
+        return [added, removed, suspected, trusted]
+
+
+    def _run(self):
+        flush_on_terminate()
+        asyncio.run(self._heartbeat())
 
 
     def start(self):
-        self._process = Process(target=self._heartbeat)
+        self._process = Process(target=self._run)
         self._process.start()
 
 
     def stop(self):
-        self._print('Stopping LFD')
+        self._logger.info('Stopping LFD')
         if self._process is not None:
+            # connections are only open in the lfd process
             self._process.terminate()
-            self._server_sock.close()
-            self._server_sock = socket.socket()
-            self._gfd_sock.close()
-            self._gfd_sock = socket.socket()
 
 
     def is_running(self):
         return self._process.is_alive()
+
+
+    def pids(self):
+        return [self._process.pid]
@@ -0,0 +1,158 @@
+""" Leveled logging, written to stdout by a background thread. """
+
+import os
+import sys
+import time
+import atexit
+import signal
+import threading
+from collections import deque
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+OFF = 100
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'off': OFF}
+
+# lines held for the writer, the oldest are dropped once it falls behind
+BUFFER_LINES = 100000
+
+# seconds between writes
+FLUSH_INTERVAL = 0.05
+
+
+def level_of(verbose):
+    """ Maps a component's verbose argument, True, False or a level name, to
+    the least severe level it logs. """
+    if verbose is True:
+        return DEBUG
+    if verbose is False or verbose is None:
+        return OFF
+    if isinstance(verbose, str):
+        return LEVELS[verbose.lower()]
+    return verbose
+
+
+class LogWriter:
+
+    def __init__(self, stream, max_lines=BUFFER_LINES):
+        self._stream = stream
+        # appended to without a lock, so logging never waits on the writer
+        self._lines = deque(maxlen=max_lines)
+        self._dropped = 0
+        # reentrant for a flush on termination that interrupts another
+        self._flush_lock = threading.RLock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+
+    def write(self, line):
+        if len(self._lines) == self._lines.maxlen:
+            self._dropped += 1
+        self._lines.append(line)
+
+
+    def flush(self):
+        with self._flush_lock:
+            lines = []
+            try:
+                while True:
+                    lines.append(self._lines.popleft())
+            except IndexError:
+                pass
+            if self._dropped:
+                lines.append(self._dropped_line(self._dropped))
+                self._dropped = 0
+            if lines:
+                try:
+                    self._stream.write(''.join(lines))
+                    self._stream.flush()
+                except (OSError, ValueError, RuntimeError):
+                    # raised by a write that interrupted another as well
+                    pass
+
+
+    def _dropped_line(self, count):
+        return f'{count} log line(s) dropped\n'
+
+
+    def _run(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+
+# one writer per process, started on first use since threads do not survive
+# a fork
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def writer():
+    global _writer, _writer_pid
+    if _writer_pid != os.getpid():
+        with _writer_lock:
+            if _writer_pid != os.getpid():
+                _writer = LogWriter(sys.stdout)
+                _writer_pid = os.getpid()
+    return _writer
+
+
+def flush():
+    if _writer_pid == os.getpid():
+        _writer.flush()
+
+
+def flush_on_terminate(*flushes):
+    """ Flushes the log, after calling flushes, when the process is
+    terminated, so a stopped component's last lines are not lost. """
+    def terminate(signum, frame):
+        for flush_other in flushes:
+            flush_other()
+        flush()
+        # then end the way the signal would have
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+    signal.signal(signal.SIGTERM, terminate)
+
+
+class Logger:
+
+    def __init__(self, prefix, verbose=True):
+        self._prefix = prefix + ': '
+        self._level = level_of(verbose)
+
+
+    def _write(self, message, args):
+        # callers pass str.format arguments so that disabled levels never
+        # format them
+        if args:
+            message = message.format(*args)
+        writer().write(self._prefix + message + '\n')
+
+
+    def debug(self, message, *args):
+        if DEBUG >= self._level:
+            self._write(message, args)
+
+
+    def info(self, message, *args):
+        if INFO >= self._level:
+            self._write(message, args)
+
+
+    def warning(self, message, *args):
+        if WARNING >= self._level:
+            self._write(message, args)
+
+
+    def flush(self):
+        flush()
+
+
+# write what is left before forking and when the main process exits, forked
+# components flush their own before exiting
+atexit.register(flush)
+os.register_at_fork(before=flush)
@@ -0,0 +1,89 @@
+""" Versioned membership views. """
+
+from collections import deque
+from itertools import islice
+from threading import Lock
+
+# membership deltas kept to answer what changed since an epoch
+HISTORY_SIZE = 1000
+
+
+class MembershipView:
+
+    def __init__(self, history=HISTORY_SIZE):
+        self._members = set()
+        self._epoch = 0
+        # [added, removed] for each epoch after the first kept one
+        self._deltas = deque(maxlen=history)
+        # updated from a thread per connection
+        self._lock = Lock()
+
+
+    def __contains__(self, member):
+        return member in self._members
+
+
+    def __len__(self):
+        return len(self._members)
+
+
+    def epoch(self):
+        return self._epoch
+
+
+    def members(self):
+        with self._lock:
+            return sorted(self._members)
+
+
+    def apply(self, added, removed):
+        """ Returns [epoch, added, removed] for the members that actually
+        changed, or None if none did. """
+        with self._lock:
+            return self._apply(added, removed)
+
+
+    def replace(self, members):
+        with self._lock:
+            members = set(members)
+            return self._apply(sorted(members - self._members),
+                               sorted(self._members - members))
+
+
+    def _apply(self, added, removed):
+        added = [member for member in dict.fromkeys(added)
+                 if member not in self._members]
+        self._members.update(added)
+        removed = [member for member in dict.fromkeys(removed)
+                   if member in self._members]
+        self._members.difference_update(removed)
+        if not added and not removed:
+            return None
+        self._epoch += 1
+        self._deltas.append([added, removed])
+        return [self._epoch, added, removed]
+
+
+    def full(self):
+        """ Returns [epoch, members, None], a view that replaces any other. """
+        with self._lock:
+            return [self._epoch, sorted(self._members), None]
+
+
+    def changes_since(self, epoch):
+        """ Returns [epoch, added, removed] to bring a view from epoch up to
+        date, or the full view if the deltas since then are gone. """
+        with self._lock:
+            first = self._epoch - len(self._deltas)
+            if epoch is None or not first <= epoch <= self._epoch:
+                return [self._epoch, sorted(self._members), None]
+            # latest change to each member wins
+            present = {}
+            for added, removed in islice(self._deltas, epoch - first, None):
+                for member in added:
+                    present[member] = True
+                for member in removed:
+                    present[member] = False
+            return [self._epoch,
+                    [member for member, now in present.items() if now],
+                    [member for member, now in present.items() if not now]]
@@ -1,36 +1,172 @@
 """ Messages within the distributed system. """
 
+import struct
+
+# frame header: magic, protocol version, field count, body length
+HEADER = struct.Struct('!2sBBI')
+MAGIC = b'FT'
+VERSION = 1
+
+# field type tags, lists hold nested fields
+NONE = 0
+INT = 1
+FLOAT = 2
+STR = 3
+BYTES = 4
+LIST = 5
+
+TAG = struct.Struct('!B')
+INT_VALUE = struct.Struct('!q')
+FLOAT_VALUE = struct.Struct('!d')
+LENGTH = struct.Struct('!I')
+
+
+def _encode_field(value, parts):
+    if value is None:
+        parts.append(TAG.pack(NONE))
+    elif isinstance(value, int):
+        parts.append(TAG.pack(INT))
+        parts.append(INT_VALUE.pack(value))
+    elif isinstance(value, float):
+        parts.append(TAG.pack(FLOAT))
+        parts.append(FLOAT_VALUE.pack(value))
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        parts.append(TAG.pack(BYTES))
+        parts.append(LENGTH.pack(len(value)))
+        parts.append(value)
+    elif isinstance(value, (list, tuple)):
+        parts.append(TAG.pack(LIST))
+        parts.append(LENGTH.pack(len(value)))
+        for item in value:
+            _encode_field(item, parts)
+    else:
+        encoded = str(value).encode('utf-8')
+        parts.append(TAG.pack(STR))
+        parts.append(LENGTH.pack(len(encoded)))
+        parts.append(encoded)
+
+
+def encoded_size(value):
+    if value is None:
+        return TAG.size
+    if isinstance(value, int):
+        return TAG.size + INT_VALUE.size
+    if isinstance(value, float):
+        return TAG.size + FLOAT_VALUE.size
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return TAG.size + LENGTH.size + len(value)
+    if isinstance(value, (list, tuple)):
+        return TAG.size + LENGTH.size + sum(encoded_size(item)
+                                            for item in value)
+    return TAG.size + LENGTH.size + len(str(value).encode('utf-8'))
+
+
+def _decode_field(buffer, offset):
+    tag, = TAG.unpack_from(buffer, offset)
+    offset += TAG.size
+    if tag == NONE:
+        return None, offset
+    if tag == INT:
+        value, = INT_VALUE.unpack_from(buffer, offset)
+        return value, offset + INT_VALUE.size
+    if tag == FLOAT:
+        value, = FLOAT_VALUE.unpack_from(buffer, offset)
+        return value, offset + FLOAT_VALUE.size
+    if tag in (STR, BYTES):
+        length, = LENGTH.unpack_from(buffer, offset)
+        offset += LENGTH.size
+        value = bytes(buffer[offset:offset + length])
+        if tag == STR:
+            value = value.decode('utf-8')
+        return value, offset + length
+    if tag == LIST:
+        length, = LENGTH.unpack_from(buffer, offset)
+        offset += LENGTH.size
+        value = []
+        for _ in range(length):
+            item, offset = _decode_field(buffer, offset)
+            value.append(item)
+        return value, offset
+    raise ValueError(f'Unknown field type {tag}')
+
+
 class Message:
 
+    FIELDS = ('identifier', 'number', 'data', 'state', 'trace')
+
     def __init__(self, identifier=None, number=None, data=None, state=None,
-                 encoded=None):
-        self.valid = True
-        if encoded is not None:
-            decoded = encoded.decode('utf-8')
-            if decoded == '':
-                self.valid = False
-                return
-            parts = decoded.split('\n\n')
-            self.identifier = parts[0]
-            self.number = parts[1]
-            self.data = parts[2]
-            self.state = parts[3]
-            if self.data == '':
-                self.data = None
-            if self.state == '':
-                self.state = None
-        else:
-            self.identifier = identifier
-            self.number = number
-            self.data = data
-            self.state = state
+                 trace=None):
+        self.identifier = identifier
+        self.number = number
+        self.data = data
+        self.state = state
+        # [trace id, span id] of a traced request
+        self.trace = trace
 
 
     def encode(self):
-        if self.data is None:
-            self.data = ''
-        if self.state is None:
-            self.state = ''
-        combined = [str(self.identifier), str(self.number), str(self.data),
-                    str(self.state)]
-        return ('\n\n'.join(combined)).encode('utf-8')
+        # untraced messages leave the trace field off
+        fields = self.FIELDS if self.trace is not None else self.FIELDS[:-1]
+        parts = [b'']
+        for field in fields:
+            _encode_field(getattr(self, field), parts)
+        length = sum(len(part) for part in parts)
+        parts[0] = HEADER.pack(MAGIC, VERSION, len(fields), length)
+        return b''.join(parts)
+
+
+    @classmethod
+    def decode(cls, buffer, offset, num_fields):
+        message = cls()
+        for i in range(num_fields):
+            value, offset = _decode_field(buffer, offset)
+            # ignore trailing fields from newer peers
+            if i < len(cls.FIELDS):
+                setattr(message, cls.FIELDS[i], value)
+        return message
+
+
+def parse_header(header):
+    magic, version, num_fields, length = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Invalid message header')
+    return num_fields, length
+
+
+class MessageReader:
+    """ Buffers bytes read from one connection and splits them into
+    messages. """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._start = 0
+
+
+    def feed(self, data):
+        if self._start:
+            del self._buffer[:self._start]
+            self._start = 0
+        self._buffer += data
+
+
+    def has_message(self):
+        available = len(self._buffer) - self._start
+        if available < HEADER.size:
+            return False
+        _, _, _, length = HEADER.unpack_from(self._buffer, self._start)
+        return available >= HEADER.size + length
+
+
+    def next(self):
+        if len(self._buffer) - self._start < HEADER.size:
+            return None
+        num_fields, length = parse_header(
+            self._buffer[self._start:self._start + HEADER.size]
+        )
+        end = self._start + HEADER.size + length
+        if len(self._buffer) < end:
+            return None
+        message = Message.decode(self._buffer, self._start + HEADER.size,
+                                 num_fields)
+        self._start = end
+        return message
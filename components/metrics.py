@@ -0,0 +1,216 @@
+""" Counters, gauges and latency histograms kept by each component. """
+
+import json
+import socket
+from threading import Lock
+
+import components.utils as utils
+
+# values below SUB_BUCKETS are counted exactly, larger ones in buckets
+# within 1/64 of the value, as in an hdr histogram
+SUB_BITS = 7
+SUB_BUCKETS = 1 << SUB_BITS
+HALF_BUCKETS = SUB_BUCKETS // 2
+
+PERCENTILES = {'p50': 0.5, 'p90': 0.9, 'p99': 0.99, 'p999': 0.999}
+
+
+def _bucket(value):
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BITS
+    return SUB_BUCKETS + (shift - 1) * HALF_BUCKETS + (value >> shift) - \
+        HALF_BUCKETS
+
+
+def _highest(bucket):
+    # largest value counted in the bucket
+    if bucket < SUB_BUCKETS:
+        return bucket
+    shift, offset = divmod(bucket - SUB_BUCKETS, HALF_BUCKETS)
+    return ((offset + HALF_BUCKETS + 1) << (shift + 1)) - 1
+
+
+class Histogram:
+
+    __slots__ = ('_counts', '_count', '_total', '_min', '_max')
+
+    def __init__(self):
+        self._counts = {}
+        self._count = 0
+        self._total = 0
+        self._min = None
+        self._max = None
+
+
+    def record(self, value):
+        value = max(0, int(value))
+        bucket = _bucket(value)
+        self._counts[bucket] = self._counts.get(bucket, 0) + 1
+        self._count += 1
+        self._total += value
+        if self._min is None or value < self._min:
+            self._min = value
+        if self._max is None or value > self._max:
+            self._max = value
+
+
+    def percentile(self, fraction):
+        if not self._count:
+            return None
+        rank = max(1, fraction * self._count)
+        seen = 0
+        for bucket in sorted(self._counts):
+            seen += self._counts[bucket]
+            if seen >= rank:
+                return min(_highest(bucket), self._max)
+        return self._max
+
+
+    def summary(self):
+        result = {'count': self._count,
+                  'mean': self._total / self._count if self._count else None,
+                  'min': self._min, 'max': self._max}
+        for name, fraction in PERCENTILES.items():
+            result[name] = self.percentile(fraction)
+        return result
+
+
+class Metrics:
+
+    def __init__(self, component, identifier):
+        self._component = component
+        self._identifier = identifier
+        self._counters = {}
+        self._histograms = {}
+        # name -> function returning the current value
+        self._gauges = {}
+        # updated from a thread per connection in the gfd and rm
+        self._lock = Lock()
+
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+
+    def record(self, name, value):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.record(value)
+
+
+    def time(self, name, seconds):
+        # latencies are kept in microseconds, in histograms named *_us
+        self.record(name, seconds * 1000000)
+
+
+    def gauge(self, name, function):
+        self._gauges[name] = function
+
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'component': self._component,
+                'identifier': self._identifier,
+                'counters': dict(self._counters),
+                'gauges': {name: function()
+                           for name, function in self._gauges.items()},
+                'histograms': {name: histogram.summary()
+                               for name, histogram
+                               in self._histograms.items()},
+            }
+
+
+    def encode(self):
+        return json.dumps(self.snapshot(), separators=(',', ':'))
+
+
+async def handle_stats_async(reader, writer, identifier, stats):
+    """ Answers each message on a stats connection with a fresh snapshot from
+    the stats coroutine function. """
+    _, number, data, _ = await utils.recv_async(reader)
+    while data is not None:
+        await utils.send_async(writer, identifier, number, await stats())
+        _, number, data, _ = await utils.recv_async(reader)
+
+
+def scrape(hostport, identifier='stats', timeout=5):
+    """ Returns the stats of the component listening at hostport. """
+    sock = socket.create_connection(utils.address(hostport), timeout=timeout)
+    try:
+        utils.send(sock, identifier, 0, 'stats')
+        component_identifier, _, _, _ = utils.recv(sock)
+        if component_identifier is None:
+            raise ConnectionError(f'Connection closed by {hostport}')
+        utils.send(sock, identifier, 0, 'stats')
+        _, _, stats, _ = utils.recv(sock)
+        if stats is None:
+            raise ConnectionError(f'No stats from {hostport}')
+        return json.loads(stats)
+    finally:
+        sock.close()
+
+
+def _text_lines(stats, indent=''):
+    lines = [f'{indent}{stats["component"]} {stats["identifier"]}']
+    for name, value in sorted(stats['counters'].items()):
+        lines.append(f'{indent}  {name}: {value}')
+    for name, value in sorted(stats['gauges'].items()):
+        lines.append(f'{indent}  {name}: {value}')
+    for name, summary in sorted(stats['histograms'].items()):
+        values = ' '.join(f'{key}={value}' for key, value in summary.items()
+                          if key != 'mean')
+        mean = summary['mean']
+        if mean is not None:
+            values += f' mean={mean:.1f}'
+        lines.append(f'{indent}  {name}: {values}')
+    for nested in stats.get('partitions', []) + list(
+            stats.get('lfds', {}).values()):
+        lines.extend(_text_lines(nested, indent + '  '))
+    return lines
+
+
+def to_text(stats):
+    return '\n'.join(_text_lines(stats))
+
+
+def _labels(labels):
+    return '{' + ','.join(f'{key}="{value}"'
+                          for key, value in labels.items()) + '}'
+
+
+def _prometheus_lines(stats):
+    labels = {'component': stats['component'],
+              'identifier': stats['identifier']}
+    lines = []
+    for name, value in sorted(stats['counters'].items()):
+        lines.append(f'ft_{name}_total{_labels(labels)} {value}')
+    for name, value in sorted(stats['gauges'].items()):
+        # gauges kept per peer become one labelled series each
+        if isinstance(value, dict):
+            for peer, peer_value in sorted(value.items()):
+                if peer_value is not None:
+                    lines.append(f'ft_{name}'
+                                 f'{_labels({**labels, "peer": peer})} '
+                                 f'{peer_value}')
+        elif value is not None:
+            lines.append(f'ft_{name}{_labels(labels)} {int(value)}')
+    for name, summary in sorted(stats['histograms'].items()):
+        for key, fraction in PERCENTILES.items():
+            if summary[key] is not None:
+                quantile = {**labels, 'quantile': fraction}
+                lines.append(f'ft_{name}{_labels(quantile)} {summary[key]}')
+        lines.append(f'ft_{name}_count{_labels(labels)} {summary["count"]}')
+    for nested in stats.get('partitions', []) + list(
+            stats.get('lfds', {}).values()):
+        lines.extend(_prometheus_lines(nested))
+    return lines
+
+
+def to_prometheus(stats):
+    """ Formats stats in the prometheus text exposition format. """
+    return '\n'.join(_prometheus_lines(stats))
@@ -0,0 +1,59 @@
+""" Phi accrual failure detection from heartbeat arrival times. """
+
+import math
+from collections import deque
+
+# inter-arrival times kept for the estimate
+WINDOW_SIZE = 100
+
+
+class PhiAccrualDetector:
+
+    def __init__(self, interval, window=WINDOW_SIZE, min_std=None):
+        self._intervals = deque(maxlen=window)
+        self._sum = 0.0
+        self._squares = 0.0
+        # keeps regular heartbeats from making any delay look fatal
+        self._min_std = interval / 4 if min_std is None else min_std
+        self._last = None
+
+        # until replies arrive, expect one every interval
+        self._add(interval - interval / 4)
+        self._add(interval + interval / 4)
+
+
+    def _add(self, interval):
+        if len(self._intervals) == self._intervals.maxlen:
+            oldest = self._intervals.popleft()
+            self._sum -= oldest
+            self._squares -= oldest * oldest
+        self._intervals.append(interval)
+        self._sum += interval
+        self._squares += interval * interval
+
+
+    def heartbeat(self, now):
+        if self._last is not None:
+            self._add(now - self._last)
+        self._last = now
+
+
+    def phi(self, now):
+        """ Suspicion that the heartbeats have stopped, -log10 of the chance
+        that a heartbeat still arrives this late. """
+        if self._last is None:
+            return 0.0
+        count = len(self._intervals)
+        mean = self._sum / count
+        variance = max(0.0, self._squares / count - mean * mean)
+        std = max(math.sqrt(variance), self._min_std)
+
+        # logistic approximation of the normal distribution
+        elapsed = now - self._last
+        y = max((elapsed - mean) / std, -10.0)
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if elapsed > mean:
+            if e == 0.0:
+                return math.inf
+            return -math.log10(e / (1 + e))
+        return -math.log10(1 - 1 / (1 + e))
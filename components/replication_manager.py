@@ -1,20 +1,20 @@
 """ A replication manager in a distributed system. """
 
-import os
-import sys
+import time
 import socket
 from multiprocessing import Process
-from threading import Thread
+from threading import Lock, Thread
 
+from components.events import Events
+from components.log import Logger, flush_on_terminate
+from components.membership import MembershipView
+from components.metrics import Metrics
 import components.utils as utils
 
 class ReplicationManager:
 
-    def __init__(self, identifier, port, verbose=True):
-        self._stdout = sys.stdout
-        if not verbose:
-            dev_null = open(os.devnull, 'w')
-            self._stdout = dev_null
+    def __init__(self, identifier, port, events=None, verbose=True):
+        self._logger = Logger(f'RM {identifier}', verbose)
 
         # rm info
         self._identifier = identifier
@@ -25,43 +25,111 @@ class ReplicationManager:
         sock.bind(utils.address(self._hostport))
         self._sock = sock
 
-        # membership
-        self._members = []
+        # membership, pushed to every subscribed client as it changes
+        self._view = MembershipView()
+        self._subscribers = {}
+        self._subscribers_lock = Lock()
 
-        # rm process
-        self._process = None
+        self._events = Events(identifier, events)
 
+        # counters and latencies, answered to stats connections
+        self._metrics = Metrics('rm', identifier)
+        self._metrics.gauge('epoch', self._view.epoch)
+        self._metrics.gauge('members', lambda: len(self._view))
+        self._metrics.gauge('subscribers', lambda: len(self._subscribers))
 
-    def _print(self, *args, **kwargs):
-        comb_args = ' '.join(args)
-        print(f'RM {self._identifier}: ' + comb_args, **kwargs,
-              file=self._stdout)
+        # rm process
+        self._process = None
 
 
     def _handle_gfd(self, conn, gfd_identifier):
-        self._print(f'Connection from GFD {gfd_identifier}')
+        self._logger.info('Connection from GFD {}', gfd_identifier)
 
-        identifier, _, message, _ = utils.recv(conn)
+        # a full view, then deltas, each tagged with the gfd's epoch
+        _, _, message, _ = utils.recv(conn)
         while message is not None:
-            if message == 'add':
-                self._members.append(identifier)
-                self._print(f'Added member {identifier}')
-                self._print(f'Current members: {self._members}')
-            elif message == 'remove':
-                self._members.remove(identifier)
-                self._print(f'Removed member {identifier}')
-                self._print(f'Current members: {self._members}')
-            identifier, _, message, _ = utils.recv(conn)
-
-        self._print(f'Connection closed by GFD {gfd_identifier}')
-        for member in self._members:
-            self._members.remove(member)
-            self._print(f'Removed member {member}')
-        self._print(f'Current members: {self._members}')
+            _, added, removed = message
+            if removed is None:
+                self._update(self._view.replace(added))
+            else:
+                self._update(self._view.apply(added, removed))
+            _, _, message, _ = utils.recv(conn)
+
+        self._logger.info('Connection closed by GFD {}', gfd_identifier)
+        self._metrics.incr('gfd_lost')
+        self._events.emit('gfd_lost', gfd_identifier)
+        self._update(self._view.replace([]))
+
+
+    def _update(self, change):
+        if change is None:
+            return
+        epoch, added, removed = change
+        for member in added:
+            self._logger.info('Added member {}', member)
+        for member in removed:
+            self._logger.info('Removed member {}', member)
+        self._logger.info('Current members (epoch {}): {}', epoch,
+                          self._view.members())
+        self._metrics.incr('view_changes')
+        self._metrics.incr('members_added', len(added))
+        self._metrics.incr('members_removed', len(removed))
+
+        started_at = time.perf_counter()
+        with self._subscribers_lock:
+            for conn in list(self._subscribers):
+                try:
+                    utils.send(conn, self._identifier, epoch, change)
+                except OSError:
+                    del self._subscribers[conn]
+        self._metrics.time('push_us', time.perf_counter() - started_at)
+
+
+    def _handle_subscriber(self, conn, identifier, epoch):
+        self._logger.info('Subscription from {}', identifier)
+
+        # registered with the view it starts from, so no change is missed
+        with self._subscribers_lock:
+            try:
+                utils.send(conn, self._identifier, epoch,
+                           self._view.changes_since(epoch))
+            except OSError:
+                return
+            self._subscribers[conn] = identifier
+
+        # subscribers only send to unsubscribe
+        message = utils.recv(conn)
+        while message[0] is not None:
+            message = utils.recv(conn)
+
+        self._logger.info('Subscription closed by {}', identifier)
+        with self._subscribers_lock:
+            self._subscribers.pop(conn, None)
+        conn.close()
+
+
+    def _handle_view(self, conn, identifier):
+        self._logger.debug('Membership queries from {}', identifier)
+
+        # each query asks for the changes since the epoch in its number
+        _, epoch, query, _ = utils.recv(conn)
+        while query is not None:
+            utils.send(conn, self._identifier, epoch,
+                       self._view.changes_since(epoch))
+            _, epoch, query, _ = utils.recv(conn)
+
+
+    def _handle_stats(self, conn):
+        # each message asks for a fresh snapshot
+        _, number, data, _ = utils.recv(conn)
+        while data is not None:
+            utils.send(conn, self._identifier, number, self._metrics.encode())
+            _, number, data, _ = utils.recv(conn)
 
 
     def _listen(self):
-        self._print(f'Starting at hostport {self._hostport}')
+        flush_on_terminate()
+        self._logger.info('Starting at hostport {}', self._hostport)
         self._sock.listen()
 
         while True:
@@ -71,6 +139,14 @@ class ReplicationManager:
             # check for gfd
             if data == 'gfd':
                 Thread(target=self._handle_gfd, args=[conn, identifier]).start()
+            elif data == 'view':
+                Thread(target=self._handle_view,
+                       args=[conn, identifier]).start()
+            elif data == 'subscribe':
+                Thread(target=self._handle_subscriber,
+                       args=[conn, identifier, number]).start()
+            elif data == 'stats':
+                Thread(target=self._handle_stats, args=[conn]).start()
 
 
     def start(self):
@@ -79,7 +155,7 @@ class ReplicationManager:
 
 
     def stop(self):
-        self._print('Stopping RM')
+        self._logger.info('Stopping RM')
         if self._process is not None:
             self._process.terminate()
             self._sock.shutdown(socket.SHUT_RDWR)
@@ -89,5 +165,9 @@ class ReplicationManager:
         return self._process.is_alive()
 
 
+    def pids(self):
+        return [self._process.pid]
+
+
     def hostport(self):
         return self._hostport
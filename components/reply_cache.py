@@ -0,0 +1,56 @@
+""" Replies to applied requests, kept to answer retries. """
+
+from collections import OrderedDict
+
+from components.message import encoded_size
+
+# encoded bytes of replies kept before the oldest are evicted
+REPLY_CACHE_BYTES = 1024 * 1024
+
+
+class ReplyCache:
+
+    def __init__(self, max_bytes=REPLY_CACHE_BYTES):
+        self._max_bytes = max_bytes
+        self._num_bytes = 0
+        # (client identifier, number) -> (reply, encoded size), oldest first
+        self._replies = OrderedDict()
+
+
+    def __len__(self):
+        return len(self._replies)
+
+
+    def get(self, client_identifier, number):
+        """ Returns the reply to a request, or None if it is not cached. """
+        entry = self._replies.get((client_identifier, number))
+        if entry is None:
+            return None
+        return entry[0]
+
+
+    def put(self, client_identifier, number, reply):
+        key = (client_identifier, number)
+        if key in self._replies:
+            self._num_bytes -= self._replies.pop(key)[1]
+        size = encoded_size([client_identifier, number, reply])
+        self._replies[key] = (reply, size)
+        self._num_bytes += size
+        while self._num_bytes > self._max_bytes:
+            _, (_, evicted) = self._replies.popitem(last=False)
+            self._num_bytes -= evicted
+
+
+    def entries(self):
+        """ Returns [client identifier, number, reply] for each cached reply,
+        oldest first. """
+        return [[client_identifier, number, reply]
+                for (client_identifier, number), (reply, _)
+                in self._replies.items()]
+
+
+    def replace(self, entries):
+        self._replies.clear()
+        self._num_bytes = 0
+        for client_identifier, number, reply in entries:
+            self.put(client_identifier, number, reply)
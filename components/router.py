@@ -0,0 +1,245 @@
+""" Routes a partitioned server's connections to its partitions. """
+
+import json
+import time
+import asyncio
+from collections import deque
+
+from components.metrics import handle_stats_async
+from components.server_state import (READ, is_operation, is_read, partition,
+                                     request_key)
+import components.utils as utils
+
+class Router:
+
+    def __init__(self, identifier, hostport, sock, partition_hostports, logger,
+                 tracer, metrics):
+        # the partitioned server's identity, socket and instrumentation
+        self._identifier = identifier
+        self._hostport = hostport
+        self._sock = sock
+        self._partition_hostports = partition_hostports
+        self._logger = logger
+        self._tracer = tracer
+        self._metrics = metrics
+
+
+    def _split(self, request):
+        # map each partition to its part of the request and the positions of
+        # that part within a batch
+        num_partitions = len(self._partition_hostports)
+        if isinstance(request, list) and not is_operation(request):
+            parts = {}
+            for position, item in enumerate(request):
+                index = partition(request_key(item), num_partitions)
+                items, positions = parts.setdefault(index, ([], []))
+                items.append(item)
+                positions.append(position)
+            return parts
+        return {partition(request_key(request), num_partitions):
+                (request, None)}
+
+
+    def _split_read(self, request):
+        # every partition answers with its version, checked once they are
+        # summed
+        owned = self._split(request[2])
+        split = {}
+        for index in range(len(self._partition_hostports)):
+            part, positions = owned.get(index, ([], []))
+            split[index] = ([READ, 0, part], positions)
+        return split
+
+
+    async def _open_partitions(self, identifier, number, data, conns):
+        for partition_hostport in self._partition_hostports:
+            reader, writer = await asyncio.open_connection(
+                *utils.address(partition_hostport)
+            )
+            conns.append((reader, writer))
+            await utils.send_async(writer, identifier, number, data)
+            partition_identifier, _, _, _ = await utils.recv_async(reader)
+            if partition_identifier is None:
+                raise ConnectionError('Partition closed the connection')
+
+
+    async def _handle_lfd(self, reader, writer, lfd_identifier, conns):
+        self._logger.info('Connection from LFD {}', lfd_identifier)
+
+        _, number, heartbeat, _ = await utils.recv_async(reader)
+        while heartbeat is not None:
+            # alive only while every partition answers
+            for _, partition_writer in conns:
+                await utils.send_async(partition_writer, lfd_identifier,
+                                       number, heartbeat)
+            responses = [await utils.recv_async(partition_reader)
+                         for partition_reader, _ in conns]
+            if any(response[2] is None for response in responses):
+                self._logger.warning('Partition stopped responding')
+                break
+            await utils.send_async(writer, self._identifier, number, heartbeat)
+            _, number, heartbeat, _ = await utils.recv_async(reader)
+
+        self._logger.info('Connection closed by LFD {}', lfd_identifier)
+
+
+    @staticmethod
+    async def _partition_replies(reader, pending):
+        # partitions answer each connection in order
+        while True:
+            _, _, response, _ = await utils.recv_async(reader)
+            if response is None:
+                while pending:
+                    pending.popleft().set_result(None)
+                return
+            pending.popleft().set_result(response)
+
+
+    @staticmethod
+    def _merge(request, results):
+        # put each partition's results back in request order
+        if isinstance(request, list) and not is_operation(request):
+            response = [None for item in request]
+            for result, positions in results:
+                if not isinstance(result, list):
+                    # a partition backup logs its part and answers 'ok'
+                    result = [result for position in positions]
+                for position, value in zip(positions, result):
+                    response[position] = value
+            return response
+        return results[0][0]
+
+
+    def _merge_read(self, request, results):
+        # the version of a partitioned server counts every partition's updates
+        _, min_version, query = request
+        if any(result == 'stale' for result, _ in results):
+            return 'stale'
+        version = sum(result[0] for result, _ in results)
+        if version < min_version:
+            return 'stale'
+        return [version, self._merge(query, [(result[1], positions)
+                                             for result, positions in results
+                                             if positions != []])]
+
+
+    async def _respond(self, writer, replies):
+        while True:
+            number, request, parts, received_at, span = await replies.get()
+            results = [(await future, positions) for future, positions in parts]
+            if any(result is None for result, _ in results):
+                writer.close()
+                return
+            if is_read(request):
+                response = self._merge_read(request, results)
+            else:
+                response = self._merge(request, results)
+            await utils.send_async(writer, self._identifier, number, response)
+            self._tracer.finish(span, partitions=len(parts))
+            if is_read(request):
+                self._metrics.incr('reads')
+                self._metrics.time('read_us', time.perf_counter() - received_at)
+            else:
+                self._metrics.incr('requests')
+                self._metrics.time('request_us',
+                                   time.perf_counter() - received_at)
+
+
+    async def _fan_out(self, conns, pending, client_identifier, number,
+                       request, trace):
+        """ Sends each partition its part of a request. Returns the future
+        of each part's result with the positions it fills. """
+        loop = asyncio.get_running_loop()
+        if is_read(request):
+            split = self._split_read(request)
+        else:
+            split = self._split(request)
+        parts = []
+        for index, (part, positions) in split.items():
+            future = loop.create_future()
+            pending[index].append(future)
+            await utils.send_async(conns[index][1], client_identifier, number,
+                                   part, trace=trace)
+            parts.append((future, positions))
+        return parts
+
+
+    async def _forward(self, conns, pending, replies, client_identifier,
+                       number, request, trace):
+        received_at = time.perf_counter()
+        span = self._tracer.follow('route', trace)
+        if span is not None:
+            trace = span.context()
+        parts = await self._fan_out(conns, pending, client_identifier, number,
+                                    request, trace)
+        self._tracer.phase(span, 'fan_out')
+        # answered in request order once every part has its result
+        replies.put_nowait((number, request, parts, received_at, span))
+
+
+    async def _handle_client(self, reader, writer, client_identifier, conns):
+        self._logger.info('Connection from Client {}', client_identifier)
+
+        pending = [deque() for conn in conns]
+        replies = asyncio.Queue()
+        tasks = [asyncio.create_task(self._partition_replies(conns[i][0],
+                                                             pending[i]))
+                 for i in range(len(conns))]
+        tasks.append(asyncio.create_task(self._respond(writer, replies)))
+
+        _, number, request, _, trace = await utils.recv_traced_async(reader)
+        while request is not None:
+            await self._forward(conns, pending, replies, client_identifier,
+                                number, request, trace)
+            _, number, request, _, trace = await utils.recv_traced_async(reader)
+
+        for task in tasks:
+            task.cancel()
+        self._logger.info('Connection closed by Client {}', client_identifier)
+
+
+    async def _stats(self, conns):
+        # the router's own counters with those of each partition
+        stats = self._metrics.snapshot()
+        stats['partitions'] = []
+        for partition_reader, partition_writer in conns:
+            await utils.send_async(partition_writer, self._identifier, 0,
+                                   'stats')
+            _, _, partition_stats, _ = await utils.recv_async(partition_reader)
+            if partition_stats is None:
+                raise ConnectionError('Partition closed the connection')
+            stats['partitions'].append(json.loads(partition_stats))
+        return json.dumps(stats, separators=(',', ':'))
+
+
+    async def _accept(self, reader, writer):
+        identifier, number, data, _ = await utils.recv_async(reader)
+        conns = []
+        try:
+            if data in ('lfd', 'client', 'stats'):
+                await self._open_partitions(identifier, number, data, conns)
+                await utils.send_async(writer, self._identifier, number,
+                                       'server')
+                if data == 'lfd':
+                    await self._handle_lfd(reader, writer, identifier, conns)
+                elif data == 'stats':
+                    await handle_stats_async(
+                        reader, writer, self._identifier,
+                        lambda: self._stats(conns)
+                    )
+                else:
+                    await self._handle_client(reader, writer, identifier,
+                                              conns)
+        except Exception:
+            pass
+        for _, partition_writer in conns:
+            partition_writer.close()
+        writer.close()
+
+
+    async def serve(self):
+        self._logger.info('Routing hostport {} to {} partitions',
+                          self._hostport, len(self._partition_hostports))
+        server = await asyncio.start_server(self._accept, sock=self._sock)
+        async with server:
+            await server.serve_forever()
@@ -1,24 +1,65 @@
 """ A server in a distributed system. """
 
 import os
-import sys
 import time
 import socket
-import random
+import asyncio
+from collections import deque
+from functools import partial
+from itertools import islice
 from multiprocessing import Process
-from threading import Thread, Lock
 
-from components.server_state import ServerState
+from components.checkpoint_schedule import CheckpointSchedule
+from components.events import Events
+from components.log import Logger, flush_on_terminate
+from components.message import encoded_size
+from components.metrics import Metrics, handle_stats_async
+from components.reply_cache import ReplyCache
+from components.router import Router
+from components.server_state import ServerState, is_read
+from components.tracing import Tracer
+from components.wal import WriteAheadLog
 import components.utils as utils
 
+# applied requests kept for delta checkpoints
+HISTORY_SIZE = 10000
+
+# checkpoint a backup after this many updates or bytes, or every interval
+CHECKPOINT_UPDATES = 1000
+CHECKPOINT_BYTES = 64 * 1024
+
+# snapshot durable state after this many logged updates
+SNAPSHOT_UPDATES = 10000
+
+# seconds between election rounds while a higher ranked server takes over
+ELECTION_RETRY = 0.1
+
+# requests read from a client ahead of their replies, beyond which a client
+# that stops reading is held back by its connection
+REPLY_WINDOW = 128
+
+
+def _deliver(replies, number, received_at, span, result):
+    replies.put_nowait((number, received_at, span, result))
+
+
+def _resolve(future, result):
+    # the applier's result for a task waiting on it, unless it gave up
+    if future.done():
+        return
+    if isinstance(result, Exception):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
+
 class Server:
 
     def __init__(self, identifier, port, server_hostports, interval,
-                 active=False, verbose=True):
-        self._stdout = sys.stdout
-        if not verbose:
-            dev_null = open(os.devnull, 'w')
-            self._stdout = dev_null
+                 active=False, data_dir=None, partitions=1, events=None,
+                 trace_path=None, verbose=True):
+        self._logger = Logger(f'Server {identifier}', verbose)
+        # spans of requests that clients traced
+        self._tracer = Tracer(f'Server {identifier}', trace_path)
 
         # server info
         self._identifier = identifier
@@ -29,307 +70,846 @@ class Server:
         self._primary = False
         self._primary_index = None
 
+        # the highest ranked live server leads, and each new primary takes a
+        # higher term so older primaries are fenced off
+        self._term = 0
+        self._electing = False
+        self._ranked = sorted(range(len(server_hostports)),
+                              key=lambda i: utils.address(server_hostports[i]))
+
         # bind sockets
         self._sock = socket.socket()
         self._sock.bind(utils.address(self._hostport))
-        self._server_socks = [socket.socket() for hostport in server_hostports]
+        self._server_conns = [None for hostport in server_hostports]
         self._connected = [False for hostport in server_hostports]
 
         # server state
         self._state = ServerState()
         self._log = []
         self._num_requests = 0
+        self._history = deque(maxlen=HISTORY_SIZE)
+        self._applied = {}
+        self._replies = ReplyCache()
+        self._checkpoints = CheckpointSchedule(interval, CHECKPOINT_UPDATES,
+                                               CHECKPOINT_BYTES)
         self._ready = False
-        self._lock = Lock()
+        # (command, args, future) for the task that alone changes the state
+        self._commands = None
+        # (number of requests, trace context) of the last traced update,
+        # for the checkpoint that carries it
+        self._last_trace = None
+
+        # durable state, kept only in memory without a data directory
+        self._wal = None
+        if data_dir is not None:
+            self._wal = WriteAheadLog(data_dir)
+
+        # key space partitions, each replicated by its own server process
+        self._partitions = []
+        if partitions > 1:
+            for i in range(partitions):
+                partition_dir = None
+                if data_dir is not None:
+                    partition_dir = os.path.join(data_dir, str(i))
+                self._partitions.append(Server(
+                    f'{identifier}.{i}', port + 1 + i,
+                    [utils.partition_hostport(hostport, i)
+                     for hostport in server_hostports],
+                    interval, active, partition_dir, events=events,
+                    trace_path=trace_path, verbose=verbose
+                ))
+
+        self._events = Events(identifier, events)
+
+        # counters and latencies, answered to stats connections
+        self._metrics = Metrics('server', identifier)
+        if not self._partitions:
+            # a router keeps no state of its own
+            gauges = {
+                'version': lambda: self._num_requests,
+                'term': lambda: self._term,
+                'primary': lambda: self._primary,
+                'ready': lambda: self._ready,
+                'logged': lambda: len(self._log),
+                'cached_replies': lambda: len(self._replies),
+                'connected_servers': lambda: sum(self._connected),
+                'backup_lag': self._checkpoints.lags,
+            }
+            for name, function in gauges.items():
+                self._metrics.gauge(name, function)
+
+        # a partitioned server only routes to its partitions
+        self._router = None
+        if self._partitions:
+            self._router = Router(
+                identifier, self._hostport, self._sock,
+                [partition_server.hostport()
+                 for partition_server in self._partitions],
+                self._logger, self._tracer, self._metrics
+            )
 
         # server process
         self._process = None
 
 
-    def _print(self, *args, **kwargs):
-        comb_args = ' '.join(args)
-        print(f'Server {self._identifier}: ' + comb_args, **kwargs,
-              file=self._stdout)
+    def _apply(self, request):
+        # a batch is applied as one unit
+        return self._state.apply(request)
+
+
+    def _record(self, client_identifier, number, request, response):
+        self._num_requests += 1
+        self._history.append([client_identifier, number, request])
+        self._applied[client_identifier] = number
+        self._replies.put(client_identifier, number, response)
+        self._checkpoints.record(self._num_requests, encoded_size(request))
+
+
+    def _applied_list(self):
+        return [[client_identifier, number]
+                for client_identifier, number in self._applied.items()]
+
+
+    def _persist(self, client_identifier, number, request):
+        if self._wal is None:
+            return None
+        if len(self._wal) >= SNAPSHOT_UPDATES:
+            return self._snapshot()
+        return self._wal.append(client_identifier, number, request)
+
+
+    def _snapshot(self):
+        if self._wal is None:
+            return None
+        return self._wal.snapshot(self._num_requests, self._applied_list(),
+                                  self._state.serialize())
+
+
+    def _reset_state(self, state, num_requests, applied=None, replies=None):
+        self._state = state
+        self._num_requests = num_requests
+        if applied is not None:
+            self._applied = applied
+        if replies is not None:
+            self._replies.replace(replies)
+        # history no longer leads up to the new state
+        self._history.clear()
+        return self._snapshot()
+
+
+    def _recover(self):
+        snapshot, records = self._wal.load()
+        if snapshot is not None:
+            self._state = ServerState.deserialize(snapshot.state)
+            self._num_requests = snapshot.number
+            self._applied = dict(snapshot.data)
+        for record in records:
+            # a crash can leave records the snapshot already covers
+            if self._is_applied(record.identifier, record.number):
+                continue
+            response = self._apply(record.data)
+            self._record(record.identifier, record.number, record.data,
+                         response)
+        self._logger.info('Recovered state {} after {} request(s)',
+                          self._state, self._num_requests)
+
+
+    def _is_applied(self, client_identifier, number):
+        return number <= self._applied.get(client_identifier, 0)
+
+
+    def _replay_log(self):
+        span = None
+        if self._log:
+            self._logger.info('Clearing log')
+            if self._tracer.enabled:
+                span = self._tracer.start('replay_log')
+        for client_identifier, number, request in self._log:
+            if self._is_applied(client_identifier, number):
+                continue
+            try:
+                response = self._apply(request)
+            except Exception as error:
+                # the primary rejected it too, so it is dropped unrecorded
+                self._logger.warning('Dropping logged request (#{}) from '
+                                     'Client {}: {}', number,
+                                     client_identifier, error)
+                self._metrics.incr('rejected_requests')
+                continue
+            self._record(client_identifier, number, request, response)
+            self._persist(client_identifier, number, request)
+        self._tracer.finish(span, requests=len(self._log))
+        self._log = []
 
 
-    def _connect(self, index):
-        try:
-            sock = self._server_socks[index]
-            server_hostport = self._server_hostports[index]
-            sock.connect(utils.address(server_hostport))
+    def _prune_log(self):
+        # drop logged requests that a checkpoint already covers
+        self._log = [entry for entry in self._log
+                     if not self._is_applied(entry[0], entry[1])]
+
+
+    def _promote(self):
+        # a primary may have been found while the election waited its turn
+        if self._primary_index is not None:
+            return False
+        self._term += 1
+        self._primary = True
+        self._ready = True
+        self._replay_log()
+        self._metrics.incr('elected')
+        self._events.emit('elected')
+        return True
 
-            utils.send(sock, self._identifier, 0, 'server')
-            identifier, number, _, state = utils.recv(sock)
 
+    def _step_down(self, term):
+        self._logger.info('Stepping down for term {}', term)
+        self._primary = False
+        self._ready = False
+        self._term = term
+        self._metrics.incr('step_downs')
+        self._events.emit('stepped_down', term)
+
+
+    def _updates_since(self, acked):
+        first = self._num_requests - len(self._history)
+        if acked is None or not first <= acked <= self._num_requests:
+            return None
+        return list(islice(self._history, acked - first, None))
+
+
+    def _submit(self, command, *args, deliver=None):
+        """ Queues a command for the applier. Its result, or the exception it
+        raised, is passed to deliver, or to the future returned without
+        one. """
+        future = None
+        if deliver is None:
+            future = asyncio.get_running_loop().create_future()
+            deliver = partial(_resolve, future)
+        self._commands.put_nowait((command, args, deliver))
+        return future
+
+
+    async def _apply_commands(self):
+        # the only task that changes the state, one command at a time in the
+        # order they were submitted, so no state lock is held across network
+        # i/o, and changes of role need none since they never await
+        while True:
+            command, args, deliver = await self._commands.get()
+            try:
+                result = command(*args)
+            except Exception as error:
+                result = error
+            deliver(result)
+
+
+    def _catch_up(self, state, num_requests):
+        # a newer state from a peer, or an active replica's own, with this
+        # server's logged requests replayed on top
+        if num_requests > self._num_requests:
+            self._logger.info('Updating state')
+            self._reset_state(state, num_requests)
+            self._replay_log()
+        elif self.is_active():
+            # requests logged while no peer had answered yet
+            self._replay_log()
+        self._ready = True
+
+
+    def _disconnect(self, index):
+        if self._server_conns[index] is not None:
+            _, writer = self._server_conns[index]
+            writer.close()
+            self._server_conns[index] = None
+        self._connected[index] = False
+
+
+    async def _handshake(self, index):
+        reader, writer = await asyncio.open_connection(
+            *utils.address(self._server_hostports[index])
+        )
+        self._server_conns[index] = (reader, writer)
+        await utils.send_async(writer, self._identifier, 0, 'server')
+        return await utils.recv_async(reader)
+
+
+    async def _connect(self, index):
+        try:
+            # a hung server may accept connections without answering
+            identifier, number, _, state = await asyncio.wait_for(
+                self._handshake(index), self._interval
+            )
             # make sure server is still connected
             if identifier is None:
-                sock.close()
-                self._server_socks[index] = socket.socket()
-                self._connected[index] = False
+                self._disconnect(index)
             else:
-                self._print(f'Connected to Server {identifier}')
+                self._logger.info('Connected to Server {}', identifier)
                 # update state
-                if number > self._num_requests:
-                    with self._lock:
-                        self._print('Updating state')
-                        self._state = state
-                        self._num_requests = number
-                        if self._log:
-                            self._print('Clearing log')
-                        for request in self._log:
-                            self._state.update(int(request))
-                        self._log = []
-                        self._ready = True
-                self._ready = True
+                await self._submit(self._catch_up, state, number)
                 self._connected[index] = True
         except Exception:
-            self._connected[index] = False
+            self._disconnect(index)
 
 
-    def _handle_lfd(self, conn, lfd_identifier):
-        self._print(f'Connection from LFD {lfd_identifier}')
+    async def _reconnect(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            for i, connected in enumerate(self._connected):
+                if not connected:
+                    await self._connect(i)
 
-        _, number, heartbeat, _ = utils.recv(conn)
+
+    async def _handle_lfd(self, reader, writer, lfd_identifier):
+        self._logger.info('Connection from LFD {}', lfd_identifier)
+
+        _, number, heartbeat, _ = await utils.recv_async(reader)
         while heartbeat is not None:
-            utils.send(conn, self._identifier, number, heartbeat)
-            _, number, heartbeat, _ = utils.recv(conn)
+            self._metrics.incr('heartbeats')
+            await utils.send_async(writer, self._identifier, number, heartbeat)
+            _, number, heartbeat, _ = await utils.recv_async(reader)
 
-        self._print(f'Connection closed by LFD {lfd_identifier}')
+        self._logger.info('Connection closed by LFD {}', lfd_identifier)
 
 
-    def _handle_primary(self, conn):
-        _, number, num_requests, checkpoint = utils.recv(conn)
+    async def _stats(self):
+        return self._metrics.encode()
 
-        while checkpoint is not None:
-            self._print(f'Received checkpoint (#{number}) {checkpoint}')
 
-            if int(num_requests) > self._num_requests:
-                with self._lock:
-                    self._state = checkpoint
-                    self._num_requests = int(num_requests)
-                    for request in self._log:
-                        self._state.update(int(request))
-                    self._log = []
+    async def _primary_lost(self):
+        if self._primary_index is not None:
+            self._logger.warning('Connection closed by Primary')
+            self._events.emit('primary_lost')
+            self._disconnect(self._primary_index)
+            self._primary_index = None
+        await self._elect()
+
+
+    def _apply_checkpoint(self, number, checkpoint, state, span):
+        """ Applies a checkpoint from the primary. Returns whether a newer
+        primary has fenced it off, and what to wait on before acknowledging
+        it. """
+        self._tracer.phase(span, 'queued')
+        num_requests, term = checkpoint[0], checkpoint[2]
+        durable = None
+        fenced = term < self._term
+        self._metrics.incr('checkpoints_received')
+        if fenced:
+            self._metrics.incr('checkpoints_fenced')
+            self._logger.warning('Ignoring checkpoint (#{}) from term {}',
+                                 number, term)
+        elif state is not None:
+            # full snapshot with the last request applied per client and the
+            # replies a new primary answers retries with
+            self._logger.debug('Received checkpoint (#{}) {}', number, state)
+            # the first checkpoint from a new primary is authoritative
+            if num_requests > self._num_requests or not self._ready:
+                durable = self._reset_state(state, num_requests,
+                                            dict(checkpoint[1]),
+                                            checkpoint[3])
+                self._prune_log()
+            if not self._ready:
+                # in sync with a new primary
+                self._ready = True
+                self._events.emit('ready')
+        else:
+            # requests applied since the last acknowledged checkpoint
+            updates = checkpoint[1]
+            self._logger.debug('Received checkpoint (#{}) {} update(s)',
+                               number, len(updates))
+            if num_requests - len(updates) == self._num_requests:
+                for client_identifier, request_number, request in updates:
+                    response = self._apply(request)
+                    self._record(client_identifier, request_number, request,
+                                 response)
+                    durable = self._persist(client_identifier, request_number,
+                                            request)
+                self._prune_log()
+
+        if not fenced:
+            self._term = term
+        self._tracer.phase(span, 'apply')
+        return fenced, durable
+
+
+    async def _handle_primary(self, reader, writer):
+        _, number, checkpoint, state, trace = \
+            await utils.recv_traced_async(reader)
+
+        while isinstance(checkpoint, list):
+            span = self._tracer.follow('apply_checkpoint', trace)
+            fenced, durable = await self._submit(
+                self._apply_checkpoint, number, checkpoint, state, span
+            )
 
             try:
-                utils.send(conn, self._identifier, number, 'ok')
-                _, number, num_requests, checkpoint = utils.recv(conn)
+                if fenced:
+                    # a newer primary has been elected since
+                    await utils.send_async(writer, self._identifier,
+                                           self._term, 'fenced')
+                    self._tracer.finish(span, fenced=True)
+                    break
+                # acknowledge only what is durable
+                if durable is not None:
+                    await durable
+                    self._tracer.phase(span, 'durable')
+                await utils.send_async(writer, self._identifier, number,
+                                       self._num_requests)
+                self._tracer.phase(span, 'send')
+                self._tracer.finish(span, version=self._num_requests)
+                _, number, checkpoint, state, trace = \
+                    await utils.recv_traced_async(reader)
             except Exception:
-                with self._lock:
-                    if self._primary_index is not None:
-                        self._print('Connection closed by Primary')
-                        self._connected[self._primary_index] = False
-                        self._primary_index = None
-                time.sleep(1 + random.random() * 5)
-                self._elect()
-                return
+                break
 
-        with self._lock:
-            if self._primary_index is not None:
-                self._print('Connection closed by Primary')
-                self._connected[self._primary_index] = False
-                self._primary_index = None
-        time.sleep(1 + random.random() * 5)
-        self._elect()
+        await self._primary_lost()
 
 
-    def _handle_backup(self, conn, identifier):
+    async def _handle_backup(self, reader, writer, identifier):
+        self._checkpoints.add(identifier)
         number = 1
-        while True:
-            self._print(f'Sending checkpoint (#{number}) {self._state} to '
-                        f'Server {identifier}')
+        acked = None
+        sent_through = 0
+        while self.is_primary():
+            # full snapshot on first sync or if the backup fell too far behind
+            updates = self._updates_since(acked)
+            if updates == []:
+                # skip checkpoints with nothing new
+                await self._checkpoints.wait(identifier)
+                continue
+            sent_at = time.perf_counter()
+            # traced as part of the last traced update it carries
+            span = None
+            if (self._last_trace is not None and
+                    self._last_trace[0] > sent_through):
+                span = self._tracer.start('checkpoint', self._last_trace[1])
+            trace = None if span is None else span.context()
+            # updates recorded while the checkpoint drains are not in it
+            version = self._num_requests
+            if updates is None:
+                self._metrics.incr('full_checkpoints_sent')
+            else:
+                self._metrics.record('checkpoint_updates', len(updates))
+                self._metrics.record('checkpoint_bytes',
+                                     self._checkpoints.unsent_bytes(identifier))
             try:
-                utils.send(conn, self._identifier, number, self._num_requests,
-                           state=self._state)
-                _, _, res, _ = utils.recv(conn)
+                if updates is None:
+                    self._logger.debug('Sending checkpoint (#{}) {} to '
+                                       'Server {}', number, self._state,
+                                       identifier)
+                    await utils.send_async(writer, self._identifier, number,
+                                           [version, self._applied_list(),
+                                            self._term,
+                                            self._replies.entries()],
+                                           state=self._state, trace=trace)
+                else:
+                    self._logger.debug('Sending checkpoint (#{}) {} '
+                                       'update(s) to Server {}', number,
+                                       len(updates), identifier)
+                    await utils.send_async(writer, self._identifier, number,
+                                           [version, updates, self._term],
+                                           trace=trace)
+                self._tracer.phase(span, 'send')
+                sent_through = version
+                self._checkpoints.sent(identifier, version)
+                _, res_number, res, _ = await utils.recv_async(reader)
             except Exception:
                 res = None
             if res is None:
-                self._print(f'Connection closed by Server {identifier}')
-                return
+                self._logger.info('Connection closed by Server {}', identifier)
+                break
+            self._metrics.incr('checkpoints_sent')
+            self._metrics.time('checkpoint_rtt_us',
+                               time.perf_counter() - sent_at)
+            self._tracer.finish(span, backup=identifier, full=updates is None,
+                                version=sent_through)
+            if res == 'fenced':
+                if self.is_primary() and res_number > self._term:
+                    self._step_down(res_number)
+                if not self.is_primary():
+                    asyncio.create_task(self._elect())
+                break
+            if isinstance(res, int):
+                acked = res
+                self._checkpoints.acknowledge(identifier, acked)
 
             number += 1
-            time.sleep(self._interval)
-
+            await self._checkpoints.wait(identifier)
+        self._checkpoints.remove(identifier)
+
+
+    def _read(self, min_version, query):
+        """ Answers a query from local state with [version, result], or
+        'stale' if the state has not caught up with min_version. """
+        if not self._ready or self._num_requests < min_version:
+            return 'stale'
+        # reads change nothing, so they are neither logged nor replicated
+        return [self._num_requests, self._apply(query)]
+
+
+    def _query(self, request, span):
+        # any replica in sync with a primary answers reads
+        self._tracer.phase(span, 'queued')
+        return self._read(request[1], request[2]), None, 'read'
+
+
+    def _update(self, client, number, request, span):
+        """ Applies, logs or answers again a client's update. Returns the
+        response, what to wait on before sending it, and the outcome. """
+        self._tracer.phase(span, 'queued')
+        durable = None
+        if not self._ready or (not self.is_active() and
+                               not self.is_primary()):
+            if not self._is_applied(client, number):
+                self._log.append([client, number, request])
+                self._logger.debug('Added request to log')
+                self._metrics.incr('logged_requests')
+            response = 'ok'
+            outcome = 'logged'
+        elif self._is_applied(client, number):
+            # a retry is answered without applying it again, or only
+            # acknowledged once its reply has been evicted
+            response = self._replies.get(client, number)
+            if response is None:
+                response = 'ok'
+            self._metrics.incr('retries')
+            outcome = 'retry'
+        else:
+            try:
+                response = self._apply(request)
+            except Exception as error:
+                # answered without changing the state, so a retry is
+                # rejected again
+                self._logger.warning('Rejecting (#{}) from Client {}: {}',
+                                     number, client, error)
+                self._metrics.incr('rejected_requests')
+                self._tracer.phase(span, 'apply')
+                return 'error', None, 'rejected'
+            self._record(client, number, request, response)
+            durable = self._persist(client, number, request)
+            outcome = 'applied'
+            if span is not None:
+                self._last_trace = (self._num_requests, span.context())
+        self._tracer.phase(span, 'apply')
+        return response, durable, outcome
+
+
+    async def _reply(self, writer, client_identifier, replies, window):
+        # responses in request order, as the applier produces them
+        while True:
+            reply = await replies.get()
+            if reply is None:
+                return
+            # once the connection fails the rest are only drained
+            if not writer.is_closing():
+                await self._send_reply(writer, client_identifier, *reply)
+            window.release()
 
-    def _handle_client(self, conn, client_identifier):
-        self._print(f'Connection from Client {client_identifier}')
 
-        _, number, request, _ = utils.recv(conn)
+    async def _send_reply(self, writer, client_identifier, number,
+                          received_at, span, result):
+        try:
+            if isinstance(result, Exception):
+                raise result
+            response, durable, outcome = result
+            # reply once the update is durable, committing with other
+            # clients
+            if durable is not None:
+                await durable
+                self._tracer.phase(span, 'durable')
+            self._logger.debug('Sending (#{}) {} to Client {}', number,
+                               response, client_identifier)
+            await utils.send_async(writer, self._identifier, number,
+                                   response)
+        except Exception:
+            writer.close()
+            return
+        self._tracer.phase(span, 'send')
+        if outcome == 'read':
+            self._metrics.incr('reads')
+            if response == 'stale':
+                self._metrics.incr('stale_reads')
+            self._metrics.time('read_us', time.perf_counter() - received_at)
+            self._tracer.finish(span, outcome=outcome,
+                                stale=response == 'stale')
+        else:
+            self._metrics.incr('requests')
+            self._metrics.time('request_us',
+                               time.perf_counter() - received_at)
+            self._tracer.finish(span, outcome=outcome)
+
+
+    async def _handle_client(self, reader, writer, client_identifier,
+                             session):
+        self._logger.info('Connection from Client {}', client_identifier)
+        # requests are applied once per client run
+        client = f'{client_identifier}:{session}'
+
+        # a slow client holds up only its own replies
+        replies = asyncio.Queue()
+        window = asyncio.Semaphore(REPLY_WINDOW)
+        replier = asyncio.create_task(self._reply(writer, client_identifier,
+                                                  replies, window))
+
+        _, number, request, _, trace = await utils.recv_traced_async(reader)
         while request is not None:
-            self._print(f'Received (#{number}) {request} from Client '
-                        f'{client_identifier}')
-
-            with self._lock:
-                if (not self._ready or (not self.is_active() and
-                                        not self.is_primary())):
-                    self._log.append(request)
-                    self._print('Added request to log')
-                    utils.send(conn, self._identifier, number, 'ok')
-                else:
-                    response = self._state.update(int(request))
-                    self._num_requests += 1
-                    self._print(f'Sending (#{number}) {response} to Client '
-                                f'{client_identifier}')
-                    utils.send(conn, self._identifier, number, response)
-
-            _, number, request, _ = utils.recv(conn)
+            await window.acquire()
+            received_at = time.perf_counter()
+            span = self._tracer.follow('handle_client', trace)
+            self._logger.debug('Received (#{}) {} from Client {}', number,
+                               request, client_identifier)
+            # the applier passes the result on to the replier
+            deliver = partial(_deliver, replies, number, received_at, span)
+            if is_read(request):
+                self._submit(self._query, request, span, deliver=deliver)
+            else:
+                self._submit(self._update, client, number, request, span,
+                             deliver=deliver)
+            _, number, request, _, trace = await utils.recv_traced_async(reader)
 
-        self._print(f'Connection closed by Client {client_identifier}')
+        replies.put_nowait(None)
+        await replier
+        self._logger.info('Connection closed by Client {}', client_identifier)
 
 
-    def _run_active(self, conn, identifier, number, data):
+    async def _run_active(self, reader, writer, identifier, number, data):
         while True:
             # check connection type
             if data == 'lfd':
-                utils.send(conn, self._identifier, number, 'server')
-                self._handle_lfd(conn, identifier)
+                await utils.send_async(writer, self._identifier, number,
+                                       'server')
+                await self._handle_lfd(reader, writer, identifier)
                 return
             if data == 'client':
-                utils.send(conn, self._identifier, number, 'server')
-                self._handle_client(conn, identifier)
+                await utils.send_async(writer, self._identifier, number,
+                                       'server')
+                await self._handle_client(reader, writer, identifier,
+                                          number)
+                return
+            if data == 'stats':
+                await utils.send_async(writer, self._identifier, number,
+                                       'server')
+                await handle_stats_async(reader, writer, self._identifier,
+                                         self._stats)
                 return
             if data == 'server':
-                utils.send(conn, self._identifier, self._num_requests,
-                           'server', self._state)
+                await utils.send_async(writer, self._identifier,
+                                       self._num_requests, 'server',
+                                       self._state)
             if data is None:
                 return
-            identifier, number, data, _ = utils.recv(conn)
+            identifier, number, data, _ = await utils.recv_async(reader)
 
 
-    def _elect(self):
-        for i in range(len(self._server_socks)):
-            sock = self._server_socks[i]
-            try:
-                utils.send(sock, self._identifier, 0, 'elect')
-                identifier, number, data, _ = utils.recv(sock)
-                self._lock.acquire()
-                if self._primary_index is not None:
-                    self._lock.release()
-                    return
-                if data is not None and 'primary' in data:
-                    self._primary = False
-                    self._ready = False
-                    self._primary_index = i
-                    utils.send(sock, self._identifier, number,
-                               'backup')
-                    self._print('Primary: ' + identifier)
-                    self._lock.release()
-                    Thread(target=self._run_passive,
-                           args=[sock, identifier, number, data]).start()
-                    return
-                if data == 'approve':
-                    self._primary = True
-                    self._ready = True
-                    self._primary_index = None
-                    utils.send(sock, self._identifier, number,
-                               'primary|' + self._hostport)
-                    self._print('Elected Primary')
-                    self._lock.release()
-                    Thread(target=self._run_passive,
-                           args=[sock, identifier, number, data]).start()
-                    return
-                self._lock.release()
-            except Exception:
-                pass
-        # no other servers have responded
-        with self._lock:
-            self._primary = True
-            self._ready = True
-            self._primary_index = None
-        self._print('Default Primary')
+    def _outranks(self, index):
+        # lower addresses win elections
+        return (utils.address(self._server_hostports[index]) <
+                utils.address(self._hostport))
 
 
-    def _run_passive(self, conn, identifier, number, data):
+    async def _elect(self):
+        if self._electing:
+            return
+        self._electing = True
+        started_at = time.perf_counter()
+        try:
+            while not await self._elect_round():
+                await asyncio.sleep(ELECTION_RETRY)
+        finally:
+            self._electing = False
+        self._metrics.incr('elections')
+        self._metrics.time('election_us', time.perf_counter() - started_at)
+
+
+    async def _probe(self, reader, writer):
+        await utils.send_async(writer, self._identifier, self._term, 'elect')
+        return await utils.recv_async(reader)
+
+
+    async def _elect_round(self):
+        """ Follows a live primary, or becomes primary if no live server
+        outranks this one. Returns False to retry. """
+        waiting = False
+        for i in self._ranked:
+            if self.is_primary() or self._primary_index is not None:
+                return True
+            if self._server_conns[i] is None:
+                continue
+            reader, writer = self._server_conns[i]
+            try:
+                # a hung server is passed over like a failed one
+                identifier, term, data, _ = await asyncio.wait_for(
+                    self._probe(reader, writer), self._interval
+                )
+            except Exception:
+                data = None
+            if data is None:
+                self._disconnect(i)
+                continue
+            if (isinstance(data, str) and 'primary' in data and
+                    term >= self._term):
+                self._primary = False
+                self._ready = False
+                self._primary_index = i
+                self._term = term
+                self._logger.info('Primary: {} (term {})', identifier, term)
+                asyncio.create_task(
+                    self._run_passive(reader, writer, identifier, term, data)
+                )
+                return True
+            self._term = max(self._term, term)
+            # wait for a server that still follows a primary, or that
+            # outranks this one and will lead
+            if data == 'disapprove' or self._outranks(i):
+                waiting = True
+        if waiting:
+            return False
+        # the logged requests are replayed by the applier
+        if await self._submit(self._promote):
+            self._logger.info('Elected Primary (term {})', self._term)
+        return True
+
+
+    async def _run_passive(self, reader, writer, identifier, number, data):
         while True:
             # check connection type
             if data == 'lfd':
-                utils.send(conn, self._identifier, number, 'server')
-                self._handle_lfd(conn, identifier)
+                await utils.send_async(writer, self._identifier, number,
+                                       'server')
+                await self._handle_lfd(reader, writer, identifier)
                 return
             if data == 'client':
-                utils.send(conn, self._identifier, number, 'server')
-                self._handle_client(conn, identifier)
+                await utils.send_async(writer, self._identifier, number,
+                                       'server')
+                await self._handle_client(reader, writer, identifier,
+                                          number)
+                return
+            if data == 'stats':
+                await utils.send_async(writer, self._identifier, number,
+                                       'server')
+                await handle_stats_async(reader, writer, self._identifier,
+                                         self._stats)
                 return
             if data == 'server':
-                utils.send(conn, self._identifier, self._num_requests,
-                           'server', self._state)
+                await utils.send_async(writer, self._identifier,
+                                       self._num_requests, 'server',
+                                       self._state)
             elif data == 'elect':
-                with self._lock:
-                    if not self.is_primary() and self._primary_index is None:
-                        utils.send(conn, self._identifier, number, 'approve')
-                    elif self._primary_index is not None:
-                        utils.send(conn, self._identifier, number,
-                                   'disapprove')
-                    else:
-                        utils.send(conn, self._identifier, number,
-                                   'primary|' + self._hostport)
-            elif data is not None and 'primary' in data:
-                with self._lock:
-                    if self._primary_index is None:
-                        self._print('Primary: ' + identifier)
-                    self._primary = False
-                    self._ready = False
-                    server_hostport = data.split('|')[1]
-                    self._primary_index = self._server_hostports.index(
-                        server_hostport
-                    )
-                utils.send(conn, self._identifier, number, 'backup')
-                self._handle_primary(conn)
+                stepped_down = False
+                if number > self._term:
+                    # a candidate has seen a newer term than this primary
+                    if self.is_primary():
+                        self._step_down(number)
+                        stepped_down = True
+                    self._term = number
+                if self.is_primary():
+                    response = 'primary|' + self._hostport
+                elif self._primary_index is not None:
+                    response = 'disapprove'
+                else:
+                    response = 'approve'
+                await utils.send_async(writer, self._identifier, self._term,
+                                       response)
+                if stepped_down:
+                    asyncio.create_task(self._elect())
+            elif isinstance(data, str) and 'primary' in data:
+                if self._primary_index is None:
+                    self._logger.info('Primary: {}', identifier)
+                self._primary = False
+                self._ready = False
+                server_hostport = data.split('|')[1]
+                self._primary_index = self._server_hostports.index(
+                    server_hostport
+                )
+                await utils.send_async(writer, self._identifier, number,
+                                       'backup')
+                await self._handle_primary(reader, writer)
             elif data == 'backup':
                 if self.is_primary():
-                    self._handle_backup(conn, identifier)
+                    await self._handle_backup(reader, writer, identifier)
                     return
             if data is None:
                 return
-            identifier, number, data, _ = utils.recv(conn)
+            identifier, number, data, _ = await utils.recv_async(reader)
 
 
-    def _listen(self):
-        self._print(f'Starting at hostport {self._hostport}')
-        self._sock.listen()
+    async def _accept(self, reader, writer):
+        identifier, number, data, _ = await utils.recv_async(reader)
+        try:
+            if self.is_active():
+                await self._run_active(reader, writer, identifier, number,
+                                       data)
+            else:
+                await self._run_passive(reader, writer, identifier, number,
+                                        data)
+        except Exception:
+            pass
+        writer.close()
+
+
+    async def _serve(self):
+        self._logger.info('Starting at hostport {}', self._hostport)
+        # restore durable state before joining the group
+        if self._wal is not None:
+            self._recover()
+        self._commands = asyncio.Queue()
+        asyncio.create_task(self._apply_commands())
+        server = await asyncio.start_server(self._accept, sock=self._sock)
         for i, connected in enumerate(self._connected):
             if not connected:
-                self._connect(i)
-        self._elect()
+                await self._connect(i)
+        # active replicas all serve requests, so there is nothing to elect,
+        # even without a peer to catch up with
+        if self.is_active():
+            await self._submit(self._catch_up, self._state, self._num_requests)
+        else:
+            await self._elect()
 
-        while True:
-            for i, connected in enumerate(self._connected):
-                if not connected:
-                    self._connect(i)
-            conn, _ = self._sock.accept()
-            identifier, number, data, _ = utils.recv(conn)
-            if self.is_active():
-                Thread(target=self._run_active,
-                       args=[conn, identifier, number, data]).start()
-            else:
-                Thread(target=self._run_passive,
-                       args=[conn, identifier, number, data]).start()
+        asyncio.create_task(self._reconnect())
+        async with server:
+            await server.serve_forever()
+
+
+    def _listen(self):
+        flush_on_terminate(self._tracer.flush)
+        if self._router is not None:
+            asyncio.run(self._router.serve())
+        else:
+            asyncio.run(self._serve())
 
 
     def start(self):
+        for partition_server in self._partitions:
+            partition_server.start()
         self._process = Process(target=self._listen)
         self._process.start()
 
 
     def stop(self):
-        self._print('Stopping server')
+        for partition_server in self._partitions:
+            partition_server.stop()
+        self._logger.info('Stopping server')
         if self._process is not None:
             # stop serving requests
             self._process.terminate()
 
-            # stop listening for connections
-            self._sock.shutdown(socket.SHUT_RDWR)
-            for i in range(len(self._server_socks)):
-                if self._connected[i]:
-                    self._server_socks[i].close()
-                    self._server_socks[i] = socket.socket()
+            # stop listening for connections, the socket only listens in the
+            # server process
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
 
     def is_running(self):
         return self._process.is_alive()
 
 
+    def pids(self):
+        pids = [self._process.pid]
+        for partition_server in self._partitions:
+            pids.extend(partition_server.pids())
+        return pids
+
+
     def hostport(self):
         return self._hostport
 
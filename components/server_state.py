@@ -1,15 +1,151 @@
+import sys
+import json
+import zlib
+import struct
+from array import array
+
+# key updated by requests that carry only a number
+DEFAULT_KEY = ''
+
+OPERATIONS = ('get', 'put', 'incr')
+
+# ['read', min_version, query], answered by any replica without replicating
+READ = 'read'
+
+# snapshot: version and key count, then key lengths, values and key bytes
+SNAPSHOT_HEADER = struct.Struct('!BI')
+SNAPSHOT_VERSION = 1
+
+# values are 64 bit signed integers in snapshots and messages
+MIN_VALUE = -2 ** 63
+MAX_VALUE = 2 ** 63 - 1
+
+
+def is_operation(request):
+    return (isinstance(request, list) and len(request) > 1 and
+            request[0] in OPERATIONS)
+
+
+def is_query(request):
+    # gets, alone or in a batch, leave the state unchanged
+    if is_operation(request):
+        return request[0] == 'get'
+    return (isinstance(request, list) and
+            all(is_operation(item) and item[0] == 'get' for item in request))
+
+
+def is_read(request):
+    return (isinstance(request, list) and len(request) == 3 and
+            request[0] == READ and isinstance(request[1], int) and
+            is_query(request[2]))
+
+
+def request_key(request):
+    if is_operation(request):
+        return str(request[1])
+    return DEFAULT_KEY
+
+
+def partition(key, num_partitions):
+    # stable across processes, unlike hash()
+    return zlib.crc32(key.encode('utf-8')) % num_partitions
+
+
+def _to_network_order(values):
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
 class ServerState:
 
-    def __init__(self, state=None):
-        self._sum = 0
-        if state is not None:
-            self._sum = int(state)
+    __slots__ = ('_values',)
+
+    def __init__(self, values=None):
+        self._values = {}
+        if values is not None:
+            self._values = dict(values)
 
 
     def __str__(self):
-        return str(self._sum)
+        return json.dumps(self._values, separators=(',', ':'))
+
+
+    def serialize(self):
+        keys = [key.encode('utf-8') for key in self._values]
+        lengths = _to_network_order(array('I', [len(key) for key in keys]))
+        values = _to_network_order(array('q', self._values.values()))
+        return b''.join([SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION, len(keys)),
+                         lengths.tobytes(), values.tobytes()] + keys)
+
+
+    @classmethod
+    def deserialize(cls, buffer):
+        view = memoryview(buffer)
+        version, count = SNAPSHOT_HEADER.unpack_from(view)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f'Unknown snapshot version {version}')
+        offset = SNAPSHOT_HEADER.size
+        lengths = array('I')
+        lengths.frombytes(view[offset:offset + count * lengths.itemsize])
+        offset += count * lengths.itemsize
+        values = array('q')
+        values.frombytes(view[offset:offset + count * values.itemsize])
+        offset += count * values.itemsize
+        _to_network_order(lengths)
+        _to_network_order(values)
+
+        state = cls()
+        for length, value in zip(lengths, values):
+            key = str(view[offset:offset + length], 'utf-8')
+            state._values[key] = value
+            offset += length
+        return state
+
+
+    def get(self, key):
+        return self._values.get(key, 0)
+
+
+    def put(self, key, value):
+        self._values[key] = value
+        return value
+
+
+    def incr(self, key, amount):
+        value = self._values.get(key, 0) + amount
+        self._values[key] = value
+        return value
 
 
     def update(self, value):
-        self._sum += value
-        return self._sum
+        return self.incr(DEFAULT_KEY, value)
+
+
+    def apply(self, request):
+        """ Applies an operation, a batch or an update to the default key and
+        returns its result. A request that fails changes nothing. """
+        changes = {}
+        result = self._evaluate(request, changes)
+        self._values.update(changes)
+        return result
+
+
+    def _evaluate(self, request, changes):
+        # an operation is [name, key, value], any other list is a batch
+        if not is_operation(request):
+            if isinstance(request, list):
+                return [self._evaluate(item, changes) for item in request]
+            request = ['incr', DEFAULT_KEY, request]
+        operation, key = request[0], str(request[1])
+        value = changes[key] if key in changes else self.get(key)
+        if operation == 'get':
+            return value
+        if operation == 'put':
+            value = int(request[2])
+        else:
+            value += int(request[2])
+        if not MIN_VALUE <= value <= MAX_VALUE:
+            raise ValueError(f'Value of {key!r} out of range: {value}')
+        changes[key] = value
+        return value
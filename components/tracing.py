@@ -0,0 +1,164 @@
+""" Sampled request spans, written in the chrome trace event format. """
+
+import os
+import json
+import time
+import random
+import threading
+
+from components.log import LogWriter
+
+# fraction of client requests traced when tracing is on
+TRACE_RATE = 0.01
+
+
+def new_id():
+    # fits the signed 64 bit integers messages carry
+    return random.getrandbits(63)
+
+
+def now():
+    return time.time_ns() // 1000
+
+
+class Span:
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start',
+                 'phases')
+
+    def __init__(self, name, trace_id, parent_id, start):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id()
+        self.parent_id = parent_id
+        self.start = start
+        # (name, end) of each phase, the first starting with the span
+        self.phases = []
+
+
+    def context(self):
+        """ Returns the [trace id, span id] that messages carry. """
+        return [self.trace_id, self.span_id]
+
+
+class _AppendFile:
+
+    def __init__(self, path):
+        # the viewers accept an array left open with a trailing comma, so
+        # processes only ever append whole lines
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            os.write(fd, b'[\n')
+            os.close(fd)
+        except FileExistsError:
+            pass
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+
+
+    def write(self, text):
+        # each write lands whole at the end of the file
+        data = text.encode('utf-8')
+        while data:
+            data = data[os.write(self._fd, data):]
+
+
+    def flush(self):
+        pass
+
+
+class _SpanWriter(LogWriter):
+
+    def _dropped_line(self, count):
+        # keeps the file valid json
+        return json.dumps({'name': 'spans_dropped', 'ph': 'i', 's': 'p',
+                           'ts': now(), 'pid': os.getpid(), 'tid': 0,
+                           'args': {'count': count}}) + ',\n'
+
+
+class Tracer:
+
+    def __init__(self, name, path=None, rate=TRACE_RATE):
+        self._name = name
+        self._path = path
+        self._rate = rate
+        self.enabled = path is not None
+
+        # one writer per process, started on first use like the log writer
+        self._writer = None
+        self._writer_pid = None
+        self._writer_lock = threading.Lock()
+
+
+    def _write(self, event):
+        if self._writer_pid != os.getpid():
+            with self._writer_lock:
+                if self._writer_pid != os.getpid():
+                    self._writer = _SpanWriter(_AppendFile(self._path))
+                    self._writer_pid = os.getpid()
+                    self._writer.write(json.dumps({
+                        'name': 'process_name', 'ph': 'M',
+                        'pid': os.getpid(), 'args': {'name': self._name},
+                    }) + ',\n')
+        self._writer.write(json.dumps(event) + ',\n')
+
+
+    def sample(self):
+        """ Returns whether to trace a new request. """
+        return self.enabled and random.random() < self._rate
+
+
+    def start(self, name, parent=None, start=None):
+        """ Starts a span under parent, a span or a [trace id, span id]
+        context, or a new trace without one. """
+        if isinstance(parent, Span):
+            parent = parent.context()
+        if parent is None:
+            return Span(name, new_id(), None, now() if start is None else start)
+        return Span(name, parent[0], parent[1],
+                    now() if start is None else start)
+
+
+    def follow(self, name, context, start=None):
+        """ Starts a span for a message, or returns None unless the message
+        was traced and so is this component. """
+        if context is None or not self.enabled:
+            return None
+        return self.start(name, context, start)
+
+
+    def phase(self, span, name):
+        """ Ends the part of a span since its last phase, if it has one. """
+        if span is not None:
+            span.phases.append((name, now()))
+
+
+    def _event(self, name, trace_id, span_id, parent_id, start, end, args):
+        args['trace_id'] = f'{trace_id:016x}'
+        args['span_id'] = f'{span_id:016x}'
+        if parent_id is not None:
+            args['parent_id'] = f'{parent_id:016x}'
+        self._write({
+            'name': name, 'cat': 'request', 'ph': 'X',
+            'ts': start, 'dur': max(0, end - start),
+            # each trace on its own track, where its spans nest
+            'pid': os.getpid(), 'tid': trace_id & 0x7fffffff,
+            'args': args,
+        })
+
+
+    def finish(self, span, end=None, **args):
+        if span is None:
+            return
+        end = now() if end is None else end
+        self._event(span.name, span.trace_id, span.span_id, span.parent_id,
+                    span.start, end, args)
+        start = span.start
+        for name, phase_end in span.phases:
+            self._event(name, span.trace_id, new_id(), span.span_id, start,
+                        phase_end, {})
+            start = phase_end
+
+
+    def flush(self):
+        if self._writer_pid == os.getpid():
+            self._writer.flush()
@@ -1,23 +1,82 @@
 """ Utility functions. """
 
-from components.message import Message
+import asyncio
+import weakref
+
+from components.message import HEADER, Message, MessageReader, parse_header
 from components.server_state import ServerState
 
-RECV_SIZE = 4096
+RECV_SIZE = 65536
+
+# buffered reader for each open socket
+_readers = weakref.WeakKeyDictionary()
+
+def _encode(identifier, number, data, state, trace=None):
+    if state is not None:
+        state = state.serialize()
+    return Message(identifier, number, data, state, trace).encode()
+
+
+def _decode(message):
+    if message.state is not None:
+        message.state = ServerState.deserialize(message.state)
+    return message.identifier, message.number, message.data, message.state
+
+
+def send(sock, identifier, number, data=None, state=None, trace=None):
+    sock.sendall(_encode(identifier, number, data, state, trace))
+
+
+def reader(sock):
+    sock_reader = _readers.get(sock)
+    if sock_reader is None:
+        sock_reader = MessageReader()
+        _readers[sock] = sock_reader
+    return sock_reader
+
 
-def send(sock, identifier, number, data=None, state=None):
-    sock.sendall(Message(identifier, number, data, state).encode())
+def _recv_message(sock):
+    sock_reader = reader(sock)
+    try:
+        message = sock_reader.next()
+        while message is None:
+            chunk = sock.recv(RECV_SIZE)
+            if not chunk:
+                return Message()
+            sock_reader.feed(chunk)
+            message = sock_reader.next()
+    except ValueError:
+        return Message()
+    return message
 
 
 def recv(sock):
-    encoded = sock.recv(RECV_SIZE)
-    message = Message(encoded=encoded)
-    if message.valid:
-        if message.state is not None:
-            message.state = ServerState(message.state)
-        return (message.identifier, int(message.number), message.data,
-                message.state)
-    return None, None, None, None
+    return _decode(_recv_message(sock))
+
+
+async def send_async(writer, identifier, number, data=None, state=None,
+                     trace=None):
+    writer.write(_encode(identifier, number, data, state, trace))
+    await writer.drain()
+
+
+async def _recv_message_async(stream):
+    try:
+        num_fields, length = parse_header(await stream.readexactly(HEADER.size))
+        body = await stream.readexactly(length)
+        return Message.decode(body, 0, num_fields)
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        return Message()
+
+
+async def recv_async(stream):
+    return _decode(await _recv_message_async(stream))
+
+
+async def recv_traced_async(stream):
+    """ Returns the fields recv_async does and the trace context, or None. """
+    message = await _recv_message_async(stream)
+    return _decode(message) + (message.trace,)
 
 
 def hostport(address_string):
@@ -27,3 +86,9 @@ def hostport(address_string):
 def address(hostport_string):
     parts = hostport_string.split(':')
     return (parts[0], int(parts[1]))
+
+
+def partition_hostport(hostport_string, index):
+    # partitions listen on the ports after their server's port
+    host, port = address(hostport_string)
+    return host + ':' + str(port + 1 + index)
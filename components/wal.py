@@ -0,0 +1,147 @@
+""" Write-ahead log and snapshots for durable server state. """
+
+import os
+import mmap
+import struct
+import asyncio
+import zlib
+
+from components.message import HEADER, Message, parse_header
+
+CHECKSUM = struct.Struct('!I')
+
+WAL_FILE = 'wal'
+SNAPSHOT_FILE = 'snapshot'
+
+
+def _encode_record(message):
+    frame = message.encode()
+    return CHECKSUM.pack(zlib.crc32(frame)) + frame
+
+
+def _decode_records(buffer):
+    """ Returns the valid records in buffer and the offset where they end. """
+    records = []
+    offset = 0
+    while len(buffer) - offset >= CHECKSUM.size + HEADER.size:
+        checksum, = CHECKSUM.unpack_from(buffer, offset)
+        start = offset + CHECKSUM.size
+        try:
+            num_fields, length = parse_header(buffer[start:start + HEADER.size])
+        except ValueError:
+            break
+        end = start + HEADER.size + length
+        if end > len(buffer) or zlib.crc32(buffer[start:end]) != checksum:
+            break
+        records.append(Message.decode(buffer, start + HEADER.size, num_fields))
+        offset = end
+    return records, offset
+
+
+def _read_records(path):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return [], 0
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return _decode_records(buffer)
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteAheadLog:
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._wal_path = os.path.join(directory, WAL_FILE)
+        self._snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+        self._file = None
+
+        # records waiting for the next group commit
+        self._pending = []
+        self._waiters = []
+        self._snapshot = None
+        self._flushing = None
+
+        # records written since the last snapshot
+        self._num_records = 0
+
+
+    def load(self):
+        """ Returns the latest snapshot (or None) and the logged records after
+        it, dropping a torn record at the end of the log. """
+        os.makedirs(self._directory, exist_ok=True)
+        snapshots, _ = _read_records(self._snapshot_path)
+        snapshot = snapshots[0] if snapshots else None
+
+        records, end = _read_records(self._wal_path)
+        self._file = open(self._wal_path, 'ab')
+        self._file.truncate(end)
+        self._num_records = len(records)
+        return snapshot, records
+
+
+    def __len__(self):
+        return self._num_records
+
+
+    def append(self, identifier, number, data):
+        self._pending.append(_encode_record(Message(identifier, number, data)))
+        self._num_records += 1
+        return self._commit()
+
+
+    def snapshot(self, number, data, state):
+        """ Replaces the log with a snapshot of everything appended so far. """
+        self._pending = []
+        self._snapshot = _encode_record(Message(None, number, data, state))
+        self._num_records = 0
+        return self._commit()
+
+
+    def _commit(self):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.create_task(self._flush())
+        return waiter
+
+
+    async def _flush(self):
+        loop = asyncio.get_running_loop()
+        while self._waiters:
+            # everything appended while the last write ran commits together
+            pending, self._pending = self._pending, []
+            waiters, self._waiters = self._waiters, []
+            snapshot, self._snapshot = self._snapshot, None
+            try:
+                await loop.run_in_executor(None, self._write, pending,
+                                           snapshot)
+            except Exception as error:
+                for waiter in waiters:
+                    waiter.set_exception(error)
+                continue
+            for waiter in waiters:
+                waiter.set_result(None)
+
+
+    def _write(self, pending, snapshot):
+        if snapshot is not None:
+            path = self._snapshot_path + '.tmp'
+            with open(path, 'wb') as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path, self._snapshot_path)
+            _fsync_directory(self._directory)
+            # the snapshot covers every record logged before it
+            self._file.truncate(0)
+        if pending:
+            self._file.write(b''.join(pending))
+        self._file.flush()
+        os.fsync(self._file.fileno())
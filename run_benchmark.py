@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+
+import sys
+import json
+
+import argparse
+
+from components.benchmark import FAULTS, Benchmark, FailoverBenchmark
+from components.tracing import TRACE_RATE
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-s', '--servers', default=3, help='number of servers')
+    parser.add_argument('-c', '--clients', default=1, help='number of clients')
+    parser.add_argument('-r', '--requests', default=1000, help='requests per client')
+    parser.add_argument('-a', '--active', default=False, action='store_true', help='active/passive replication')
+    parser.add_argument('-int', '--interval', default=1, help='checkpoint and heartbeat interval in seconds')
+    parser.add_argument('-w', '--window', default=1, help='max outstanding requests per server')
+    parser.add_argument('-b', '--batch', default=1, help='number of updates per request')
+    parser.add_argument('-k', '--keys', default=0, help='number of keys to increment, 0 for a single counter')
+    parser.add_argument('-n', '--partitions', default=1, help='key space partitions per server')
+    parser.add_argument('-rd', '--reads', default=0, help='fraction of requests that only read, each served by one replica')
+    parser.add_argument('-st', '--staleness', help='max updates a read may be behind the newest state a client has read, unbounded without it')
+    parser.add_argument('-f', '--fault', choices=FAULTS, help='time failover after stopping this component instead of measuring throughput')
+    parser.add_argument('-runs', '--runs', default=10, help='fault injections to time, each on a fresh cluster')
+    parser.add_argument('-p', '--port', default=9000, help='first TCP port to use')
+    parser.add_argument('-o', '--output', help='file to write JSON results to')
+    parser.add_argument('-tr', '--trace', help='file to append sampled request spans to, in the chrome trace event format')
+    parser.add_argument('-trr', '--trace_rate', default=TRACE_RATE, help='fraction of requests to trace')
+
+    args = parser.parse_args()
+
+    if args.fault is None:
+        benchmark = Benchmark(int(args.servers), int(args.clients), int(args.requests), args.active,
+                              int(args.interval), int(args.window), int(args.batch), int(args.keys),
+                              int(args.partitions), int(args.port), reads=float(args.reads),
+                              staleness=None if args.staleness is None else int(args.staleness),
+                              trace_path=args.trace, trace_rate=float(args.trace_rate))
+    else:
+        benchmark = FailoverBenchmark(args.fault, int(args.runs), int(args.servers), args.active,
+                                      int(args.interval), keys=int(args.keys), partitions=int(args.partitions),
+                                      port=int(args.port))
+    result = json.dumps(benchmark.run(), indent=2)
+
+    if args.output is None:
+        print(result)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(result + '\n')
+    sys.exit(0)
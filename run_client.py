@@ -6,6 +6,8 @@ import signal
 import argparse
 
 from components.client import Client
+from components.log import LEVELS
+from components.tracing import TRACE_RATE
 
 
 client = None
@@ -19,9 +21,18 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-i', '--identifier', help='client identifier')
-    parser.add_argument('-hp', '--hostports', help='server hostports separated by a space')
+    parser.add_argument('-hp', '--hostports', help='server hostports separated by a space, replica groups separated by a comma')
     parser.add_argument('-int', '--interval', help='client request interval in seconds')
     parser.add_argument('-l', '--limit', help='limit number of client requests')
+    parser.add_argument('-w', '--window', default=1, help='max outstanding requests per server')
+    parser.add_argument('-b', '--batch', default=1, help='number of updates per request')
+    parser.add_argument('-k', '--keys', default=0, help='number of keys to increment, 0 for a single counter')
+    parser.add_argument('-rd', '--reads', default=0, help='fraction of requests that only read, each served by one replica')
+    parser.add_argument('-st', '--staleness', help='max updates a read may be behind the newest state read, unbounded without it')
+    parser.add_argument('-rhp', '--rm_hostport', help='RM hostport to follow live servers from, all servers are tried without it')
+    parser.add_argument('-tr', '--trace', help='file to append sampled request spans to, in the chrome trace event format')
+    parser.add_argument('-trr', '--trace_rate', default=TRACE_RATE, help='fraction of requests to trace')
+    parser.add_argument('-log', '--log_level', default='debug', choices=LEVELS, help='least severe messages to print')
 
     args = parser.parse_args()
 
@@ -30,7 +41,10 @@ if __name__ == '__main__':
         print('Missing required arg(s)')
         sys.exit(1)
 
-    client = Client(args.identifier, args.hostports.split(' '), int(args.interval))
+    groups = [group.split() for group in args.hostports.split(',')]
+    client = Client(args.identifier, groups, int(args.interval), int(args.window), int(args.batch), int(args.keys),
+                    float(args.reads), None if args.staleness is None else int(args.staleness),
+                    rm_hostport=args.rm_hostport, trace_path=args.trace, trace_rate=float(args.trace_rate), verbose=args.log_level)
     client.start(args.limit)
 
     signal.signal(signal.SIGINT, stop)
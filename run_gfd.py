@@ -6,6 +6,7 @@ import signal
 import argparse
 
 from components.global_fault_detector import GlobalFaultDetector
+from components.log import LEVELS
 
 
 gfd = None
@@ -22,6 +23,7 @@ if __name__ == '__main__':
     parser.add_argument('-i', '--identifier', help='GFD identifier')
     parser.add_argument('-p', '--port', help='GFD TCP port')
     parser.add_argument('-hp', '--hostport', help='RM hostport')
+    parser.add_argument('-log', '--log_level', default='debug', choices=LEVELS, help='least severe messages to print')
 
     args = parser.parse_args()
 
@@ -30,7 +32,7 @@ if __name__ == '__main__':
         print('Missing required arg(s)')
         sys.exit(1)
 
-    gfd = GlobalFaultDetector(args.identifier, int(args.port), args.hostport)
+    gfd = GlobalFaultDetector(args.identifier, int(args.port), args.hostport, verbose=args.log_level)
     gfd.start()
 
     signal.signal(signal.SIGINT, stop)
@@ -5,7 +5,8 @@ import signal
 
 import argparse
 
-from components.local_fault_detector import LocalFaultDetector
+from components.local_fault_detector import REMOVE_PHI, SUSPECT_PHI, LocalFaultDetector
+from components.log import LEVELS
 
 
 lfd = None
@@ -19,9 +20,12 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-i', '--identifier', help='LFD identifier')
-    parser.add_argument('-shp', '--server_hostport', help='server hostport')
+    parser.add_argument('-shp', '--server_hostport', help='server hostport, or comma separated hostports of every server to monitor')
     parser.add_argument('-ghp', '--gfd_hostport', help='GFD hostport')
     parser.add_argument('-int', '--interval', help='heartbeat interval in seconds')
+    parser.add_argument('-st', '--suspect_threshold', default=SUSPECT_PHI, help='suspicion level (phi) at which a server is reported as suspect')
+    parser.add_argument('-rt', '--remove_threshold', default=REMOVE_PHI, help='suspicion level (phi) at which a server is removed')
+    parser.add_argument('-log', '--log_level', default='debug', choices=LEVELS, help='least severe messages to print')
 
     args = parser.parse_args()
 
@@ -30,7 +34,9 @@ if __name__ == '__main__':
         print('Missing required arg(s)')
         sys.exit(1)
 
-    lfd = LocalFaultDetector(args.identifier, args.server_hostport, args.gfd_hostport, int(args.interval))
+    server_hostports = args.server_hostport.split(',')
+    lfd = LocalFaultDetector(args.identifier, server_hostports, args.gfd_hostport, int(args.interval),
+                             float(args.suspect_threshold), float(args.remove_threshold), verbose=args.log_level)
     lfd.start()
 
     signal.signal(signal.SIGINT, stop)
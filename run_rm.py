@@ -5,6 +5,7 @@ import signal
 
 import argparse
 
+from components.log import LEVELS
 from components.replication_manager import ReplicationManager
 
 
@@ -21,6 +22,7 @@ if __name__ == '__main__':
 
     parser.add_argument('-i', '--identifier', help='RM identifier')
     parser.add_argument('-p', '--port', help='RM TCP port')
+    parser.add_argument('-log', '--log_level', default='debug', choices=LEVELS, help='least severe messages to print')
 
     args = parser.parse_args()
 
@@ -29,7 +31,7 @@ if __name__ == '__main__':
         print('Missing required arg(s)')
         sys.exit(1)
 
-    rm = ReplicationManager(args.identifier, int(args.port))
+    rm = ReplicationManager(args.identifier, int(args.port), verbose=args.log_level)
     rm.start()
 
     signal.signal(signal.SIGINT, stop)
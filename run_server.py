@@ -5,6 +5,7 @@ import signal
 
 import argparse
 
+from components.log import LEVELS
 from components.server import Server
 
 
@@ -24,6 +25,10 @@ if __name__ == '__main__':
     parser.add_argument('-hp', '--hostports', help='server hostports')
     parser.add_argument('-int', '--interval', help='server interval in seconds')
     parser.add_argument('-a', '--active', default=False, action='store_true', help='active/passive replication')
+    parser.add_argument('-d', '--data_dir', help='directory for durable server state')
+    parser.add_argument('-n', '--partitions', default=1, help='key space partitions, each on the ports after the server port')
+    parser.add_argument('-tr', '--trace', help='file to append spans of traced requests to')
+    parser.add_argument('-log', '--log_level', default='debug', choices=LEVELS, help='least severe messages to print')
 
     args = parser.parse_args()
 
@@ -34,7 +39,8 @@ if __name__ == '__main__':
 
     args.hostports = args.hostports.split(' ')
 
-    server = Server(args.identifier, int(args.port), args.hostports, int(args.interval), args.active)
+    server = Server(args.identifier, int(args.port), args.hostports, int(args.interval), args.active, args.data_dir, int(args.partitions),
+                    trace_path=args.trace, verbose=args.log_level)
     server.start()
 
     signal.signal(signal.SIGINT, stop)
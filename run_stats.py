@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+import sys
+import json
+import time
+
+import argparse
+
+from components.metrics import scrape, to_prometheus, to_text
+
+
+FORMATS = ['text', 'json', 'prometheus']
+
+
+def collect(hostports):
+    stats = []
+    for hostport in hostports:
+        try:
+            stats.append(scrape(hostport))
+        except OSError as e:
+            print(f'No stats from {hostport}: {e}', file=sys.stderr)
+    return stats
+
+
+def render(stats, output_format):
+    if output_format == 'json':
+        return json.dumps(stats, indent=2)
+    if output_format == 'prometheus':
+        return '\n'.join(to_prometheus(component) for component in stats)
+    return '\n\n'.join(to_text(component) for component in stats)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-hp', '--hostports', help='hostports of servers, GFDs and RMs to scrape separated by a space')
+    parser.add_argument('-f', '--format', default='text', choices=FORMATS, help='output format')
+    parser.add_argument('-o', '--output', help='file to write to instead of stdout, rewritten on each scrape')
+    parser.add_argument('-int', '--interval', help='seconds between scrapes, scraped once without it')
+
+    args = parser.parse_args()
+
+    required = [args.hostports]
+    if any(arg is None for arg in required):
+        print('Missing required arg(s)')
+        sys.exit(1)
+
+    hostports = args.hostports.split()
+    try:
+        while True:
+            output = render(collect(hostports), args.format) + '\n'
+            if args.output is None:
+                sys.stdout.write(output)
+                sys.stdout.flush()
+            else:
+                with open(args.output, 'w') as f:
+                    f.write(output)
+            if args.interval is None:
+                break
+            time.sleep(float(args.interval))
+    except KeyboardInterrupt:
+        pass